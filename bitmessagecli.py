@@ -4,17 +4,34 @@
 # Distributed under the MIT/X11 software license
 # See http://www.opensource.org/licenses/mit-license.php
 # https://bitmessage.org/wiki/API_Reference for API documentation
+import argparse
 import base64
+import collections
 import ConfigParser
 import datetime
+import hashlib
+import httplib
 import imghdr
 import json
 import os
+import Queue
 import random
+import re
+import shutil
 import signal
 import socket
+import stat
+import StringIO
+import struct
+try:
+    import sqlite3
+except ImportError:
+    # Without it the message cache only lives in memory
+    sqlite3 = None
 import subprocess
 import sys
+import tempfile
+import threading
 # Because without it we'll be warned about not being connected to the API
 import time
 import xml
@@ -26,23 +43,1262 @@ CHARACTERS = string.digits + string.ascii_letters
 SECURE_RANDOM = random.SystemRandom()
 CONFIG = ConfigParser.RawConfigParser()
 PROXY_TYPE_DICT = {'none': 'none', 'socks4a': 'SOCKS4a', 'socks5': 'SOCKS5'}
+# Every keys.dat setting api_data() checks, and the type it has to parse as
+SETTINGS_SCHEMA = [('port', 'int'),
+                   ('apienabled', 'boolean'),
+                   ('settingsversion', 'int'),
+                   ('apiport', 'int'),
+                   ('apiinterface', 'str'),
+                   ('apiusername', 'str'),
+                   ('apipassword', 'str'),
+                   ('daemon', 'boolean'),
+                   ('timeformat', 'str'),
+                   ('blackwhitelist', 'str'),
+                   ('startonlogon', 'boolean'),
+                   ('minimizetotray', 'boolean'),
+                   ('showtraynotifications', 'boolean'),
+                   ('startintray', 'boolean'),
+                   ('sockshostname', 'str'),
+                   ('socksport', 'int'),
+                   ('socksauthentication', 'boolean'),
+                   ('sockslisten', 'boolean'),
+                   ('socksusername', 'str'),
+                   ('digestalg', 'str'),
+                   ('sockspassword', 'str'),
+                   ('socksproxytype', 'str'),
+                   ('keysencrypted', 'boolean'),
+                   ('messagesencrypted', 'boolean'),
+                   ('defaultnoncetrialsperbyte', 'int'),
+                   ('defaultpayloadlengthextrabytes', 'int'),
+                   ('minimizeonclose', 'boolean'),
+                   ('maxacceptablenoncetrialsperbyte', 'int'),
+                   ('maxacceptablepayloadlengthextrabytes', 'int'),
+                   ('userlocale', 'str'),
+                   ('useidenticons', 'boolean'),
+                   ('identiconsuffix', 'str'),
+                   ('replybelow', 'boolean'),
+                   ('maxdownloadrate', 'int'),
+                   ('maxuploadrate', 'int'),
+                   ('maxoutboundconnections', 'int'),
+                   ('ttl', 'int'),
+                   ('stopresendingafterxdays', 'str'),
+                   ('stopresendingafterxmonths', 'str'),
+                   ('namecoinrpctype', 'str'),
+                   ('namecoinrpchost', 'str'),
+                   ('namecoinrpcuser', 'str'),
+                   ('namecoinrpcpassword', 'str'),
+                   ('namecoinrpcport', 'int'),
+                   ('sendoutgoingconnections', 'boolean'),
+                   ('onionhostname', 'str'),
+                   ('onionbindip', 'str'),
+                   ('hidetrayconnectionnotifications', 'boolean'),
+                   ('trayonclose', 'boolean'),
+                   ('willinglysendtomobile', 'boolean'),
+                   ('opencl', 'str')]
+SETTINGS_GETTERS = {'int': ConfigParser.RawConfigParser.getint,
+                    'boolean': ConfigParser.RawConfigParser.getboolean,
+                    'str': ConfigParser.RawConfigParser.get}
+# Looked up once here instead of on every check
+COMPILED_SETTINGS_SCHEMA = [(option, SETTINGS_GETTERS[kind]) for option, kind in SETTINGS_SCHEMA]
+# How many idle keep-alive connections to the API are held open at once
+API_POOL_SIZE = 4
+# How many calls get grouped into a single batched API request
+BATCH_SIZE = 100
+# How long to wait for the API to answer after starting the daemon
+API_READY_TIMEOUT = 60.0
+# First and longest pause between readiness probes
+API_PROBE_DELAY = 0.05
+API_PROBE_MAX_DELAY = 1.0
+# How long a successful API call vouches for the daemon being up
+API_LIVENESS_TTL = 30.0
+# Lines of daemon output kept in memory, per stream
+DAEMON_LOG_LINES = 1000
+# How many lines the daemonlog command shows
+DAEMON_LOG_TAIL = 50
+# Size the optional daemon log file is rotated at
+DAEMON_LOG_MAX_BYTES = 1048576
+# How often the supervisor checks on the daemon
+SUPERVISOR_POLL_INTERVAL = 1.0
+# Pause before restarting a crashed daemon, doubling up to the maximum
+SUPERVISOR_MIN_BACKOFF = 1.0
+SUPERVISOR_MAX_BACKOFF = 60.0
+# This many crashes within the window is treated as a crash loop
+SUPERVISOR_CRASH_LIMIT = 5
+SUPERVISOR_CRASH_WINDOW = 300.0
+# Most API calls an ApiClient has in flight at once
+API_MAX_IN_FLIGHT = 8
+# How many calls bulk operations run at once when multicall isn't there
+API_WORKERS = 4
+# Error given for calls a Ctrl-C stopped before they were sent
+CALL_CANCELLED = 'Cancelled before it was sent'
+# What a 401 from the API means
+API_UNAUTHORIZED = 'The API refused the apiusername and apipassword in keys.dat'
+# Exit codes for the non-interactive subcommands
+EXIT_OK = 0
+EXIT_FAILURE = 1
+EXIT_USAGE = 2
+EXIT_API_UNAVAILABLE = 3
+# Sent message statuses that won't change anymore
+FINAL_STATUSES = ['ackreceived', 'msgsentnoackexpected', 'broadcastsent']
+# Where the local message cache is kept, next to keys.dat
+MESSAGE_CACHE_FILE = 'messagecache.sqlite'
+# Seconds to wait for another process, like a cron job, to let go of the cache
+MESSAGE_CACHE_TIMEOUT = 30.0
+# What the message cache raises, nothing when there's no sqlite3
+CACHE_ERRORS = (sqlite3.Error,) if sqlite3 is not None else ()
+# Attachments are deduplicated here, next to keys.dat, if it exists
+ATTACHMENT_STORE_DIR = 'attachmentstore'
+# The time each box is sorted by
+BOX_TIME_FIELDS = {'inbox': 'receivedTime', 'outbox': 'lastActionTime'}
+# How long our own address list is trusted before it's fetched again
+ADDRESS_INDEX_TTL = 60.0
+# How often the unread count shown at the prompt is checked with the daemon
+UNREAD_RECONCILE_INTERVAL = 60.0
+# How many messages cached as unread have their read flag checked each time.
+# The API only hands out the whole message, so the prompt can't check them all.
+UNREAD_REFRESH_LIMIT = 50
+# Bitmessage won't send a message bigger than this, attachments included
+MAX_MESSAGE_SIZE = 262144
+# Past this we warn that the message is getting close to the limit
+MESSAGE_SIZE_WARNING = 204800
+# Attachments are read this much at a time. It's a multiple of 3, so
+# each chunk base64 encodes without padding.
+ATTACHMENT_CHUNK_SIZE = 49152
+# Attachments are decoded this much base64 at a time. It's a multiple of
+# 4, so each chunk decodes on its own.
+BASE64_DECODE_CHUNK = 65536
+# A msgid is the hex of a 32 byte hash
+MSGID_PATTERN = re.compile(r'[0-9a-fA-F]{64}$')
+# A data URI with base64 data, like the ones attachments are embedded as.
+# Ours have the file name as the subtype, like data:file/My Photo.jpg;base64,
+# so anything on the line goes up to the ;base64,
+DATA_URI_PATTERN = re.compile(r'data:(.{1,255}?);base64,\s*([A-Za-z0-9+/=\r\n]*)')
+ALT_PATTERN = re.compile(r'alt\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+# How far back from a data URI we look for the start of its tag
+TAG_LOOKBEHIND = 1024
+# Bitmessage addresses are base58 without 0, O, I and l
+BASE58_ALPHABET = '123456789abcdefghijkmnopqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ'
+BASE58_VALUES = dict((character, value) for value, character in enumerate(BASE58_ALPHABET))
+
+
+class VarintError(Exception):
+    pass
+
+
+# Returns 0 if anything isn't a base58 character, like PyBitmessage does
+def decode_base58(text):
+    number = 0
+    for character in text:
+        if character not in BASE58_VALUES:
+            return 0
+        number = number * 58 + BASE58_VALUES[character]
+    return number
+
+
+# Returns (value, bytes used). Values have to use the shortest encoding.
+def decode_varint(data):
+    if not data:
+        return (0, 0)
+    first_byte = ord(data[0])
+    if first_byte < 253:
+        return (first_byte, 1)
+    size, form, smallest = {253: (3, '>H', 253),
+                            254: (5, '>I', 65536),
+                            255: (9, '>Q', 4294967296)}[first_byte]
+    if len(data) < size:
+        raise VarintError('{0} bytes is too short for this varint'.format(len(data)))
+    value = struct.unpack(form, data[1:size])[0]
+    if value < smallest:
+        raise VarintError('{0} should have been encoded in fewer bytes'.format(value))
+    return (value, size)
+
+
+# Decodes an address the way the decodeAddress API call does, giving the
+# same fields (status, addressVersion, streamNumber and a base64 ripe)
+# without asking the daemon
+def decode_address(address):
+    address = address.strip()
+    failed = {'status': None, 'addressVersion': 0, 'streamNumber': 0, 'ripe': ''}
+    if address.startswith('BM-'):
+        address = address[3:]
+    number = decode_base58(address)
+    if number == 0:
+        failed['status'] = 'invalidcharacters'
+        return failed
+    hex_data = '{0:x}'.format(number)
+    if len(hex_data) % 2:
+        hex_data = '0' + hex_data
+    data = hex_data.decode('hex')
+    checksum = hashlib.sha512(hashlib.sha512(data[:-4]).digest()).digest()[:4]
+    if data[-4:] != checksum:
+        failed['status'] = 'checksumfailed'
+        return failed
+    try:
+        address_version, version_length = decode_varint(data[:9])
+    except VarintError:
+        failed['status'] = 'varintmalformed'
+        return failed
+    if address_version > 4 or address_version == 0:
+        failed['status'] = 'versiontoohigh'
+        return failed
+    try:
+        stream_number, stream_length = decode_varint(data[version_length:])
+    except VarintError:
+        failed['status'] = 'varintmalformed'
+        return failed
+    ripe = data[version_length + stream_length:-4]
+    if address_version == 1:
+        ripe = data[-24:-4]
+    elif address_version in [2, 3]:
+        if len(ripe) < 18:
+            failed['status'] = 'ripetooshort'
+            return failed
+        elif len(ripe) > 20:
+            failed['status'] = 'ripetoolong'
+            return failed
+        ripe = ripe.rjust(20, '\x00')
+    else:
+        # Version 4 strips the leading null bytes, so there can't be any
+        if ripe[:1] == '\x00':
+            failed['status'] = 'encodingproblem'
+            return failed
+        elif len(ripe) > 20:
+            failed['status'] = 'ripetoolong'
+            return failed
+        elif len(ripe) < 4:
+            failed['status'] = 'ripetooshort'
+            return failed
+        ripe = ripe.rjust(20, '\x00')
+    return {'status': 'success',
+            'addressVersion': address_version,
+            'streamNumber': stream_number,
+            'ripe': base64.b64encode(ripe)}
+
+
+# xmlrpclib.Transport opens a brand new connection for every call.
+# This keeps connections to the API open between calls and hands them
+# back out, for servers that keep them alive. PyBitmessage's API is a
+# SimpleXMLRPCRequestHandler, which answers with HTTP/1.0 and closes
+# every connection, so against the daemon each call still connects;
+# release_connection() just drops those. The pool only pays off behind
+# an HTTP/1.1 server, like a proxy in front of the API.
+# Idle connections are pooled per host so concurrent callers don't
+# serialize on a single socket.
+class KeepAliveTransport(xmlrpclib.Transport):
+    def __init__(self, pool_size=API_POOL_SIZE):
+        xmlrpclib.Transport.__init__(self)
+        self.pool_size = pool_size
+        self.pool_lock = threading.Lock()
+        self.idle_connections = {}
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.requests_sent = 0
+        # When the API last answered, any successful call counts
+        self.last_heartbeat = None
+
+    def get_connection(self, host):
+        with self.pool_lock:
+            self.requests_sent += 1
+            idle = self.idle_connections.get(host)
+            if idle:
+                self.connections_reused += 1
+                return idle.pop(), True
+        return self.new_connection(host), False
+
+    def new_connection(self, host):
+        with self.pool_lock:
+            self.connections_opened += 1
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        return httplib.HTTPConnection(chost)
+
+    def release_connection(self, host, connection, response):
+        # The daemon may answer with "Connection: close", don't pool those
+        if response.will_close:
+            connection.close()
+            return
+        with self.pool_lock:
+            idle = self.idle_connections.setdefault(host, [])
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def send_over(self, connection, host, handler, request_body):
+        self.send_request(connection, handler, request_body)
+        self.send_host(connection, host)
+        self.send_user_agent(connection)
+        self.send_content(connection, request_body)
+        return connection.getresponse(buffering=True)
+
+    def request(self, host, handler, request_body, verbose=0):
+        connection, reused = self.get_connection(host)
+        try:
+            response = self.send_over(connection, host, handler, request_body)
+        except (socket.error, httplib.HTTPException):
+            connection.close()
+            self.last_heartbeat = None
+            # A pooled connection goes stale when the daemon restarts or
+            # drops it, so try once more on a fresh one before giving up
+            if not reused:
+                raise
+            connection = self.new_connection(host)
+            try:
+                response = self.send_over(connection, host, handler, request_body)
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                raise
+        if response.status != 200:
+            response.read()
+            connection.close()
+            raise xmlrpclib.ProtocolError(host + handler,
+                                          response.status,
+                                          response.reason,
+                                          response.msg)
+        self.verbose = verbose
+        try:
+            result = self.parse_response(response)
+        except Exception:
+            connection.close()
+            raise
+        self.release_connection(host, connection, response)
+        self.last_heartbeat = time.time()
+        return result
+
+    def close(self):
+        with self.pool_lock:
+            for idle in self.idle_connections.values():
+                for connection in idle:
+                    connection.close()
+            self.idle_connections = {}
+        self.last_heartbeat = None
+
+    # Seconds since the API last answered, None if it hasn't yet
+    def heartbeat_age(self):
+        last_heartbeat = self.last_heartbeat
+        if last_heartbeat is None:
+            return None
+        return time.time() - last_heartbeat
+
+    def connection_stats(self):
+        with self.pool_lock:
+            return {'requests': self.requests_sent,
+                    'opened': self.connections_opened,
+                    'reused': self.connections_reused,
+                    'idle': sum(len(idle) for idle in self.idle_connections.values())}
+
+
+# The API answered a call with an 'API Error NNNN: ...' string
+class APIError(Exception):
+    def __init__(self, response):
+        Exception.__init__(self, response)
+        self.code = int(response.split()[2][:-1])
+
+
+class CallCancelled(Exception):
+    pass
+
+
+# Whether a Ctrl-C stopped any of the calls of a batch
+def batch_cancelled(results):
+    return any(error == CALL_CANCELLED for args, result, error in results)
+
+
+# An API call running on an ApiClient worker. Once done() its value or
+# the error it raised is set.
+class PendingCall(object):
+    def __init__(self, method_name, args):
+        self.method_name = method_name
+        self.args = args
+        self.finished = threading.Event()
+        self.value = None
+        self.error = None
+
+    def finish(self, value=None, error=None):
+        self.value = value
+        self.error = error
+        self.finished.set()
+
+    def done(self):
+        return self.finished.is_set()
+
+
+# Sends API calls from a fixed number of worker threads, which bounds how
+# many are in flight at once. Bulk operations hand it their calls with
+# map() when the daemon can't take them as one system.multicall.
+class ApiClient(object):
+    def __init__(self, api_url, max_in_flight=API_MAX_IN_FLIGHT, transport=None):
+        # A transport passed in is shared, so close() leaves it open
+        self.owns_transport = transport is None
+        if transport is None:
+            transport = KeepAliveTransport(pool_size=max_in_flight)
+        self.api_url = api_url
+        self.transport = transport
+        self.api = xmlrpclib.ServerProxy(api_url, transport=transport)
+        self.calls = Queue.Queue()
+        self.cancelling = threading.Event()
+        self.workers = []
+        for each in range(max_in_flight):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def work(self):
+        while True:
+            pending = self.calls.get()
+            if pending is None:
+                return
+            if self.cancelling.is_set():
+                pending.finish(error=CallCancelled(CALL_CANCELLED))
+                continue
+            try:
+                response = getattr(self.api, pending.method_name)(*pending.args)
+                if isinstance(response, basestring) and 'API Error' in response:
+                    raise APIError(response)
+            except Exception as e:
+                pending.finish(error=e)
+            else:
+                pending.finish(value=response)
+
+    # Drops the calls that haven't been sent yet, until resume()
+    def cancel(self):
+        self.cancelling.set()
+
+    def resume(self):
+        self.cancelling.clear()
+
+    def queue_calls(self, pending_calls):
+        for pending in pending_calls:
+            self.calls.put(pending)
+
+    # Runs one method over a list of argument tuples and returns
+    # (args, result, error) for each, in the order given. Ctrl-C cancels
+    # the calls that haven't been sent, the ones in flight are waited for.
+    def map(self, method_name, args_list):
+        pending_calls = [PendingCall(method_name, args) for args in args_list]
+        # Queued and waited on without taking any lock in this thread,
+        # so a Ctrl-C can't leave one held
+        feeder = threading.Thread(target=self.queue_calls, args=(pending_calls,))
+        feeder.daemon = True
+        feeder.start()
+        results = []
+        for pending in pending_calls:
+            while not pending.done():
+                try:
+                    time.sleep(0.01)
+                except KeyboardInterrupt:
+                    self.cancel()
+            if isinstance(pending.error, xmlrpclib.Fault):
+                results.append((pending.args, None, pending.error.faultString))
+            elif pending.error is not None:
+                results.append((pending.args, None, str(pending.error)))
+            else:
+                results.append((pending.args, pending.value, None))
+        self.resume()
+        return results
+
+    def close(self):
+        for each in self.workers:
+            self.calls.put(None)
+        if self.owns_transport:
+            self.transport.close()
+
+
+# Where an attachment's base64 data is in a message, and what it's called
+Attachment = collections.namedtuple('Attachment', ['file_name', 'mime', 'offset', 'length'])
+
+
+# Finds the attachments embedded in a message in one pass over it,
+# without copying or decoding their data
+def find_attachments(message):
+    for match in DATA_URI_PATTERN.finditer(message):
+        mime = match.group(1)
+        # The name is in the alt of the tag the data URI is in. Failing
+        # that, our own attachments have it as the subtype, like file/a.txt
+        tag_start = message.rfind('<', max(0, match.start() - TAG_LOOKBEHIND), match.start())
+        alt = None
+        if tag_start != -1:
+            alt = ALT_PATTERN.search(message, tag_start, match.start())
+        if alt is not None and (alt.group(1) or alt.group(2)):
+            file_name = alt.group(1) or alt.group(2)
+        elif '.' in mime.partition('/')[2]:
+            file_name = mime.partition('/')[2]
+        else:
+            file_name = 'Attachment'
+        yield Attachment(file_name, mime, match.start(2), match.end(2) - match.start(2))
+
+
+# Replaces the characters that aren't allowed in file names with ~
+def safe_file_name(file_name):
+    for each in ["/", "\\", ":", "*", "?", "'", "<", ">", "|"]:
+        file_name = file_name.replace(each, '~')
+    return file_name
+
+
+# Decodes base64, a string or a memoryview of one, into a file a chunk
+# at a time, so memory use doesn't grow with the size of the data. It's
+# written to a temporary file next to file_path and only renamed into
+# place once it's complete. If sha256 is given the data has to match it.
+# Returns the SHA-256 of what was written.
+def save_base64(encoded, file_path, sha256=None):
+    view = memoryview(encoded)
+    digest = hashlib.sha256()
+    temp_file, temp_path = tempfile.mkstemp(prefix='.{0}.'.format(os.path.basename(file_path)),
+                                            dir=os.path.dirname(file_path) or '.')
+    try:
+        with os.fdopen(temp_file, 'wb') as outfile:
+            carry = ''
+            for start in range(0, len(view), BASE64_DECODE_CHUNK):
+                # Line breaks would throw the groups of 4 out of step
+                data = carry + view[start:start + BASE64_DECODE_CHUNK].tobytes().translate(None, ' \t\r\n')
+                whole = len(data) - len(data) % 4
+                carry = data[whole:]
+                decoded = base64.b64decode(data[:whole])
+                digest.update(decoded)
+                outfile.write(decoded)
+            if carry:
+                # Some senders leave the padding off
+                decoded = base64.b64decode(carry + '=' * (-len(carry) % 4))
+                digest.update(decoded)
+                outfile.write(decoded)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        if sha256 is not None and digest.hexdigest() != sha256.lower():
+            raise ValueError('SHA-256 is {0}, expected {1}'.format(digest.hexdigest(), sha256))
+        # Windows won't rename over an existing file
+        if sys.platform.startswith('win') and os.path.exists(file_path):
+            os.remove(file_path)
+        os.rename(temp_path, file_path)
+    except TypeError as e:
+        # What b64decode raises for data that isn't valid base64
+        os.remove(temp_path)
+        raise ValueError('Invalid base64 data: {0}'.format(e))
+    except (IOError, OSError, ValueError, KeyboardInterrupt):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return digest.hexdigest()
+
+
+# Keeps one copy of each attachment, named by the SHA-256 of its data, and
+# links the names it's saved under to that copy. An index from the SHA-256
+# of the base64 text to the SHA-256 of the data lets an attachment we've
+# seen before be saved without decoding it again. Copies are read-only,
+# as every name linked to them shares them.
+class AttachmentStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.objects_path = os.path.join(path, 'objects')
+        self.index_path = os.path.join(path, 'index')
+        # Attachments get saved from several threads by exportattachments
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.objects_path):
+            os.makedirs(self.objects_path)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as index_file:
+                for line in index_file:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        self.index[parts[0]] = parts[1]
+
+    def object_path(self, sha256):
+        return os.path.join(self.objects_path, sha256[:2], sha256)
+
+    # Saves base64 data, a string or a memoryview of one, as file_path.
+    # Returns the SHA-256 of the data, like save_base64.
+    def save(self, encoded, file_path):
+        encoded_sha256 = hashlib.sha256(encoded).hexdigest()
+        with self.lock:
+            sha256 = self.index.get(encoded_sha256)
+        if sha256 is None or not os.path.exists(self.object_path(sha256)):
+            sha256 = self.add(encoded)
+            with self.lock:
+                if self.index.get(encoded_sha256) != sha256:
+                    self.index[encoded_sha256] = sha256
+                    with open(self.index_path, 'a') as index_file:
+                        index_file.write('{0} {1}\n'.format(encoded_sha256, sha256))
+        self.link(self.object_path(sha256), file_path)
+        return sha256
+
+    # Decodes into the store, unless the same data is already there
+    def add(self, encoded):
+        temp_file, temp_path = tempfile.mkstemp(prefix='.incoming.', dir=self.objects_path)
+        os.close(temp_file)
+        try:
+            sha256 = save_base64(encoded, temp_path)
+            object_path = self.object_path(sha256)
+            if os.path.exists(object_path):
+                os.remove(temp_path)
+                return sha256
+            try:
+                os.mkdir(os.path.dirname(object_path))
+            except OSError:
+                # Another thread might have just made it
+                if not os.path.isdir(os.path.dirname(object_path)):
+                    raise
+            os.chmod(temp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(temp_path, object_path)
+        except (IOError, OSError, ValueError, KeyboardInterrupt):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return sha256
+
+    # A hardlink where the filesystem allows it, otherwise a symlink,
+    # otherwise a copy
+    def link(self, object_path, file_path):
+        if os.path.lexists(file_path):
+            os.remove(file_path)
+        for make_link in [getattr(os, 'link', None), getattr(os, 'symlink', None)]:
+            if make_link is None:
+                continue
+            try:
+                make_link(os.path.abspath(object_path), file_path)
+                return
+            except OSError:
+                pass
+        shutil.copyfile(object_path, file_path)
+
+
+def base64_size(size):
+    return (size + 2) // 3 * 4
+
+
+# Builds the base64 body the API wants for a message with a file
+# attached, a chunk of the file at a time. The file is base64 encoded into
+# the attachment markup, and that text is base64 encoded again for the API
+# as it goes, straight into one preallocated buffer. All the sizes follow
+# from the file size, so they're known before the file is read.
+class AttachmentEncoder(object):
+    def __init__(self, message, file_path, is_image):
+        self.file_path = file_path
+        self.file_size = os.path.getsize(file_path)
+        file_name = os.path.basename(file_path)
+        if is_image:
+            kind, tag = 'image', 'img'
+        else:
+            kind, tag = 'file', 'attachment'
+        self.head = ('{0}\n\n'
+                     '<!-- Note: Base64 encoded {1} attachment below. -->\n\n'
+                     'Filename:{2}\n'
+                     'Filesize:{3}KB\n'
+                     'Encoding:base64\n\n'
+                     '<center>\n'
+                     "<{4} alt = \"{2}\" src='data:{1}/{2};base64, ").format(message,
+                                                                         kind,
+                                                                         file_name,
+                                                                         round(self.file_size / 1024.0, 2),
+                                                                         tag)
+        self.tail = "' />\n</center>"
+
+    # The message as Bitmessage sends it, which is what the limit is about
+    def message_size(self):
+        return len(self.head) + base64_size(self.file_size) + len(self.tail)
+
+    # The message once it's encoded for the API
+    def encoded_size(self):
+        return base64_size(self.message_size())
+
+    def encode(self):
+        self.output = bytearray(self.encoded_size())
+        self.written = 0
+        self.carry = ''
+        self.write(self.head)
+        with open(self.file_path, 'rb') as attachment_file:
+            for chunk in iter(lambda: attachment_file.read(ATTACHMENT_CHUNK_SIZE), ''):
+                self.write(base64.b64encode(chunk))
+        self.write(self.tail)
+        # Whatever is left over gets the padding
+        self.put(base64.b64encode(self.carry))
+        if self.written != len(self.output):
+            raise IOError('{0} changed while it was being read'.format(self.file_path))
+        return str(self.output)
+
+    # Encodes text into the output, holding back the bytes that don't
+    # make up a whole group of 3 until more text arrives
+    def write(self, text):
+        data = self.carry + text
+        whole = len(data) - len(data) % 3
+        self.put(base64.b64encode(data[:whole]))
+        self.carry = data[whole:]
+
+    def put(self, encoded):
+        end = self.written + len(encoded)
+        if end > len(self.output):
+            raise IOError('{0} changed while it was being read'.format(self.file_path))
+        self.output[self.written:end] = encoded
+        self.written = end
+
+
+# Our own addresses (identities and chans) from one listAddresses call,
+# looked up by address, by label, and by label without the '[chan] '
+# prefix. It's refetched after ttl seconds or once invalidate() is
+# called for something we changed.
+class AddressIndex(object):
+    def __init__(self, ttl=ADDRESS_INDEX_TTL):
+        self.ttl = ttl
+        self.loaded = None
+        self.addresses = []
+        self.by_address = {}
+        self.by_label = {}
+        self.by_chan_label = {}
+
+    def stale(self):
+        return self.loaded is None or time.time() - self.loaded > self.ttl
+
+    def invalidate(self):
+        self.loaded = None
+
+    def load(self, addresses):
+        self.addresses = addresses
+        self.by_address = {}
+        self.by_label = {}
+        self.by_chan_label = {}
+        # The first address with a label wins, like the old linear search
+        for each in addresses:
+            self.by_address[each['address']] = each['address']
+            self.by_label.setdefault(each['label'], each['address'])
+            if each['label'].startswith('[chan] '):
+                self.by_chan_label.setdefault(each['label'][len('[chan] '):], each['address'])
+        self.loaded = time.time()
+
+    # Returns the address for an address or label of ours, or None.
+    # A chan's name without the '[chan] ' its label starts with only
+    # counts with chan_names=True, so nothing else picks a chan by
+    # accident.
+    def resolve(self, text, chan_names=False):
+        indexes = [self.by_address, self.by_label]
+        if chan_names:
+            indexes.append(self.by_chan_label)
+        for index in indexes:
+            if text in index:
+                return index[text]
+        return None
+
+
+# The address book or our subscriptions, with labels base64 decoded once
+# when they're fetched. Our own adds and deletes are applied to this copy
+# rather than fetching the whole list again.
+class ContactList(object):
+    def __init__(self, ttl=ADDRESS_INDEX_TTL):
+        self.ttl = ttl
+        self.loaded = None
+        self.entries = collections.OrderedDict()
+        self.by_label = {}
+
+    def stale(self):
+        return self.loaded is None or time.time() - self.loaded > self.ttl
+
+    def invalidate(self):
+        self.loaded = None
+
+    def load(self, entries):
+        self.entries = collections.OrderedDict()
+        self.by_label = {}
+        for each in entries:
+            entry = dict(each)
+            entry['label'] = base64.b64decode(each['label'])
+            self.add(entry)
+        self.loaded = time.time()
+
+    # entry is like the API gives it, but with a plain text label
+    def add(self, entry):
+        self.remove(entry['address'])
+        self.entries[entry['address']] = entry
+        self.by_label.setdefault(entry['label'], entry['address'])
+
+    def remove(self, address):
+        entry = self.entries.pop(address, None)
+        if entry is None or self.by_label.get(entry['label']) != address:
+            return
+        del self.by_label[entry['label']]
+        # Hand the label to the next entry that has it, if there is one
+        for each in self.entries.itervalues():
+            if each['label'] == entry['label']:
+                self.by_label[each['label']] = each['address']
+                break
+
+    # Returns the address for an address or label in the list, or None
+    def resolve(self, text):
+        if text in self.entries:
+            return text
+        return self.by_label.get(text)
+
+
+# Raised when a subcommand reaches a prompt, since nobody is there to answer
+class PromptRequired(Exception):
+    pass
+
+
+# Drains the daemon's stdout and stderr from background threads, so a
+# chatty daemon can never fill up a pipe and block. The last lines of
+# each stream are kept in bounded buffers, and optionally appended to a
+# log file that gets rotated once it reaches DAEMON_LOG_MAX_BYTES.
+class DaemonOutput(object):
+    def __init__(self, process, max_lines=DAEMON_LOG_LINES, log_path=None):
+        self.lock = threading.Lock()
+        self.buffers = {'stdout': collections.deque(maxlen=max_lines),
+                        'stderr': collections.deque(maxlen=max_lines)}
+        self.log_path = log_path
+        self.log_file = None
+        # Set once the daemon says it's up, or that it was already running
+        self.ready = threading.Event()
+        self.already_running = False
+        self.open_streams = 2
+        for name, stream in [('stdout', process.stdout), ('stderr', process.stderr)]:
+            reader = threading.Thread(target=self.read_stream, args=(name, stream))
+            reader.daemon = True
+            reader.start()
+
+    def read_stream(self, name, stream):
+        for line in iter(stream.readline, ''):
+            self.add_line(name, line.rstrip('\r\n'))
+        stream.close()
+        with self.lock:
+            self.open_streams -= 1
+            if not self.open_streams:
+                # The daemon is gone, don't leave anyone waiting on it
+                self.ready.set()
+                if self.log_file is not None:
+                    self.log_file.close()
+                    self.log_file = None
+
+    def add_line(self, name, line):
+        with self.lock:
+            self.buffers[name].append((time.time(), name, line))
+            if self.log_path is not None:
+                self.write_log(name, line)
+        if 'Another instance' in line:
+            self.already_running = True
+            self.ready.set()
+        elif line.startswith('Running as a daemon.'):
+            self.ready.set()
+
+    # Only called with self.lock held
+    def write_log(self, name, line):
+        try:
+            if self.log_file is None:
+                self.log_file = open(self.log_path, 'a')
+            if self.log_file.tell() >= DAEMON_LOG_MAX_BYTES:
+                self.log_file.close()
+                if os.path.exists(self.log_path + '.1'):
+                    os.remove(self.log_path + '.1')
+                os.rename(self.log_path, self.log_path + '.1')
+                self.log_file = open(self.log_path, 'a')
+            self.log_file.write('{0} [{1}] {2}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'), name, line))
+            self.log_file.flush()
+        except (IOError, OSError):
+            # Keep draining the pipes even if the log can't be written
+            self.log_path = None
+
+    def wait_ready(self, timeout):
+        self.ready.wait(timeout)
+        return self.ready.is_set()
+
+    # The last lines from both streams, oldest first
+    def tail(self, lines=DAEMON_LOG_TAIL):
+        with self.lock:
+            combined = list(self.buffers['stdout']) + list(self.buffers['stderr'])
+        combined.sort(key=lambda each: each[0])
+        return combined[-lines:]
+
+
+# Watches the daemon from a background thread and restarts it when it
+# dies, even if nobody is typing. Restarts back off exponentially, and a
+# daemon that keeps crashing is left down instead of being respawned in
+# a tight loop. Keeps uptime, restart and exit code figures for status.
+class DaemonSupervisor(object):
+    def __init__(self, bitmessage):
+        self.bitmessage = bitmessage
+        # Keeps the watcher and preparations() from restarting at once
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.watcher = None
+        self.started_at = None
+        self.restarts = 0
+        self.last_exit_code = None
+        self.backoff = SUPERVISOR_MIN_BACKOFF
+        self.crash_times = collections.deque(maxlen=SUPERVISOR_CRASH_LIMIT)
+        self.crash_looping = False
+
+    # Whether the daemon is up. The process we started only tells us so
+    # while it runs: with daemon = True, which api_data() sets,
+    # bitmessagemain.py forks and that process exits once the daemon is
+    # up, and when another instance was already running ours exits right
+    # away. After that the API is what counts.
+    def daemon_running(self):
+        process = self.bitmessage.enable_bm
+        if not process:
+            return False
+        if process.poll() is None:
+            return True
+        # The forked daemon takes a moment to bring the API up. A crash
+        # exits with an error, so it isn't given the time.
+        if (process.returncode == 0 and self.started_at is not None and
+                time.time() - self.started_at < API_READY_TIMEOUT):
+            return True
+        if self.api_answering():
+            return True
+        output = self.bitmessage.daemon_output
+        if output is not None:
+            output.already_running = False
+        return False
+
+    # Any call in the last API_LIVENESS_TTL counts, otherwise it's asked
+    def api_answering(self):
+        alive, age = self.bitmessage.api_liveness()
+        if alive:
+            return True
+        api = self.bitmessage.api
+        if not api:
+            return False
+        try:
+            return self.bitmessage.api_port_open() and api.add(2, 3) == 5
+        except (socket.error, httplib.HTTPException, xmlrpclib.Error):
+            return False
+
+    # Starts the daemon, or starts it again if it isn't running anymore.
+    # Nothing is started during a crash loop, only a restart the user asked
+    # for with forced=True gives the daemon another chance.
+    # Returns whether the daemon was started.
+    def restart(self, forced=False):
+        with self.lock:
+            if self.daemon_running():
+                return False
+            if forced:
+                self.crash_looping = False
+                self.crash_times.clear()
+            elif self.crash_looping:
+                return False
+            if self.bitmessage.enable_bm:
+                self.restarts += 1
+            self.bitmessage.bm_active = False
+            self.bitmessage.run_bitmessage()
+            self.started_at = time.time()
+        if self.watcher is None:
+            self.watcher = threading.Thread(target=self.watch)
+            self.watcher.daemon = True
+            self.watcher.start()
+        return True
+
+    def watch(self):
+        while not self.stopped.wait(SUPERVISOR_POLL_INTERVAL):
+            if self.crash_looping or self.daemon_running():
+                continue
+            self.handle_exit(self.bitmessage.enable_bm.returncode)
+
+    def handle_exit(self, exit_code):
+        now = time.time()
+        self.last_exit_code = exit_code
+        # A daemon that stayed up for a while earns a quick restart again
+        if self.started_at is not None and now - self.started_at > SUPERVISOR_CRASH_WINDOW:
+            self.backoff = SUPERVISOR_MIN_BACKOFF
+        self.crash_times.append(now)
+        if (len(self.crash_times) == SUPERVISOR_CRASH_LIMIT and
+                now - self.crash_times[0] < SUPERVISOR_CRASH_WINDOW):
+            self.crash_looping = True
+            print('\nBitmessage daemon crashed {0} times in {1:.0f}s, not restarting it. '
+                  'See daemonlog, and restartdaemon to try again.'.format(SUPERVISOR_CRASH_LIMIT, now - self.crash_times[0]))
+            return
+        if exit_code == 0:
+            # Like a forked daemon whose API went away, we can't see its exit
+            print('\nBitmessage daemon stopped answering, restarting in {0:g}s'.format(self.backoff))
+        else:
+            print('\nBitmessage daemon exited with code {0}, restarting in {1:g}s'.format(exit_code, self.backoff))
+        if self.stopped.wait(self.backoff):
+            return
+        self.backoff = min(self.backoff * 2, SUPERVISOR_MAX_BACKOFF)
+        if self.restart():
+            self.bitmessage.wait_for_api()
+
+    def stop(self):
+        self.stopped.set()
+
+    def uptime(self):
+        if self.started_at is None or not self.daemon_running():
+            return None
+        return time.time() - self.started_at
+
+
+# Messages we already downloaded, by msgid
+class MessageStore(object):
+    def __init__(self):
+        self.messages = {}
+
+    def known_ids(self):
+        return set(self.messages)
+
+    def get(self, message_id):
+        return self.messages.get(message_id)
+
+    def add(self, messages):
+        for each in messages:
+            self.messages[each['msgid']] = each
+
+    def remove(self, message_ids):
+        for each in message_ids:
+            self.messages.pop(each, None)
+
+    def get_many(self, message_ids):
+        return dict((each, self.messages[each]) for each in message_ids if each in self.messages)
+
+    def set_read(self, message_id, read):
+        if message_id in self.messages:
+            self.messages[message_id]['read'] = read
+
+    # Sent messages whose status can still change
+    def in_flight(self):
+        return [each for each in self.messages.itervalues()
+                if each.get('status') is not None and each['status'] not in FINAL_STATUSES]
+
+    # The toAddress of each unread message, by msgid
+    def unread_ids(self):
+        return dict((message_id, each['toAddress']) for message_id, each in self.messages.iteritems()
+                    if not each.get('read', True))
+
+
+# Same as MessageStore, but kept on disk so messages downloaded in an
+# earlier session don't have to be downloaded again. Both boxes share one
+# table, with the message itself stored as JSON and the fields we look
+# things up by pulled out into indexed columns.
+class SqliteMessageStore(object):
+    def __init__(self, path, box):
+        self.box = box
+        self.time_field = BOX_TIME_FIELDS[box]
+        self.lock = threading.Lock()
+        # Bulk operations may use the store from worker threads,
+        # self.lock keeps them from using the connection at the same time
+        self.connection = sqlite3.connect(path, timeout=MESSAGE_CACHE_TIMEOUT, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS messages ('
+                                    'box TEXT NOT NULL, '
+                                    'msgid TEXT NOT NULL, '
+                                    'toAddress TEXT, '
+                                    'fromAddress TEXT, '
+                                    'actionTime REAL, '
+                                    'read INTEGER, '
+                                    'data TEXT NOT NULL, '
+                                    'status TEXT, '
+                                    'PRIMARY KEY (box, msgid))')
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(messages)')]
+            if 'status' not in columns:
+                # A cache from before sent statuses had a column gets it filled in once
+                self.connection.execute('ALTER TABLE messages ADD COLUMN status TEXT')
+                rows = self.connection.execute("SELECT msgid, data FROM messages WHERE box = 'outbox'").fetchall()
+                self.connection.executemany("UPDATE messages SET status = ? WHERE box = 'outbox' AND msgid = ?",
+                                            [(json.loads(data).get('status'), msgid) for msgid, data in rows])
+            for column in ['toAddress', 'fromAddress', 'actionTime', 'read', 'status']:
+                self.connection.execute('CREATE INDEX IF NOT EXISTS messages_{0} '
+                                        'ON messages (box, {0})'.format(column))
+
+    def known_ids(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT msgid FROM messages WHERE box = ?', (self.box,))
+            return set(row[0] for row in rows)
+
+    def load(self, row):
+        message = json.loads(row[0])
+        if row[1] is not None:
+            message['read'] = bool(row[1])
+        return message
+
+    def get(self, message_id):
+        with self.lock:
+            row = self.connection.execute('SELECT data, read FROM messages WHERE box = ? AND msgid = ?',
+                                          (self.box, message_id)).fetchone()
+        if row is not None:
+            return self.load(row)
+
+    def get_many(self, message_ids):
+        messages = {}
+        message_ids = list(message_ids)
+        # Stay under SQLite's limit on how many parameters a query can have
+        for start in range(0, len(message_ids), 500):
+            chunk = message_ids[start:start + 500]
+            query = ('SELECT msgid, data, read FROM messages WHERE box = ? '
+                     'AND msgid IN ({0})'.format(', '.join('?' * len(chunk))))
+            with self.lock:
+                rows = self.connection.execute(query, [self.box] + chunk).fetchall()
+            for row in rows:
+                messages[row[0]] = self.load(row[1:])
+        return messages
+
+    def add(self, messages):
+        rows = []
+        for each in messages:
+            read = each.get('read')
+            if read is not None:
+                read = int(read)
+            rows.append((self.box,
+                         each['msgid'],
+                         each.get('toAddress'),
+                         each.get('fromAddress'),
+                         float(each.get(self.time_field) or 0),
+                         read,
+                         json.dumps(each),
+                         each.get('status')))
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def remove(self, message_ids):
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM messages WHERE box = ? AND msgid = ?',
+                                        [(self.box, each) for each in message_ids])
+
+    def set_read(self, message_id, read):
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE messages SET read = ? WHERE box = ? AND msgid = ?',
+                                    (int(read), self.box, message_id))
+
+    def in_flight(self):
+        query = ('SELECT data, read FROM messages WHERE box = ? '
+                 'AND status NOT IN ({0})'.format(', '.join('?' * len(FINAL_STATUSES))))
+        with self.lock:
+            rows = self.connection.execute(query, [self.box] + FINAL_STATUSES).fetchall()
+        return [self.load(row) for row in rows]
+
+    def unread_ids(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT msgid, toAddress FROM messages WHERE box = ? AND read = 0',
+                                           (self.box,))
+            return dict(rows.fetchall())
+
+
+# Unread inbox messages per identity, kept up to date from the messages
+# we sync and the ones we mark or trash ourselves, so the prompt doesn't
+# have to count them. reconcile() starts over from the message cache,
+# after sync_box() has fetched the read flags of its unread messages again.
+class UnreadCounter(object):
+    def __init__(self, interval=UNREAD_RECONCILE_INTERVAL):
+        self.interval = interval
+        self.reconciled = None
+        self.unread = {}
+        self.counts = {}
+
+    def stale(self):
+        return self.reconciled is None or time.time() - self.reconciled > self.interval
+
+    def reconcile(self, unread_ids):
+        self.unread = {}
+        self.counts = {}
+        for message_id, to_address in unread_ids.iteritems():
+            self.set_read(message_id, False, to_address)
+        self.reconciled = time.time()
+
+    def set_read(self, message_id, read, to_address=None):
+        if read:
+            to_address = self.unread.pop(message_id, None)
+            if to_address is not None:
+                self.counts[to_address] -= 1
+        elif message_id not in self.unread and to_address is not None:
+            self.unread[message_id] = to_address
+            self.counts[to_address] = self.counts.get(to_address, 0) + 1
+
+    # Takes in messages as the API gives them
+    def update(self, messages):
+        for each in messages:
+            self.set_read(each['msgid'], each.get('read', True), each['toAddress'])
+
+    def remove(self, message_ids):
+        for each in message_ids:
+            self.set_read(each, True)
+
+    def total(self, identities):
+        return sum(count for to_address, count in self.counts.iteritems() if to_address in identities)
+
+
+# Message numbers that stay put for the whole session. Positions in the
+# box shift whenever a message is deleted, these don't: a msgid keeps its
+# number, new msgids get the next one and numbers aren't reused.
+# The first listing numbers messages in box order, like positions did.
+class MessageHandles(object):
+    def __init__(self):
+        self.message_ids = {}
+        self.handles = {}
+        self.next_handle = 0
+
+    def handle(self, message_id):
+        if message_id not in self.handles:
+            self.handles[message_id] = self.next_handle
+            self.message_ids[self.next_handle] = message_id
+            self.next_handle += 1
+        return self.handles[message_id]
+
+    # Brings the table in line with the msgids a box has now
+    def update(self, message_ids):
+        current = set(message_ids)
+        self.forget([each for each in self.handles if each not in current])
+        for each in message_ids:
+            self.handle(each)
+
+    def forget(self, message_ids):
+        for each in message_ids:
+            handle = self.handles.pop(each, None)
+            if handle is not None:
+                del self.message_ids[handle]
+
+    # Returns None for a number no message has
+    def message_id(self, handle):
+        return self.message_ids.get(handle)
 
 
 class Bitmessage(object):
     def __init__(self):
         # What we'll use to actually connect to Bitmessage ( main() )
         self.api = ''
+        # Shared by every ServerProxy we build so connections outlive them
+        self.api_transport = KeepAliveTransport()
         # Works even if you're in the same directory as the cli
         # and bitmessagemain, which os.path.dirname(__file__) didn't
         self.program_dir = os.path.dirname(os.path.realpath(__file__))
         self.keys_path = self.program_dir
         self.keys_file = os.path.join(self.keys_path, 'keys.dat')
+        # (mtime, size) of keys.dat when we last read or wrote it
+        self.config_stamp = None
+        self.config_valid = False
         self.bm_active = False
         # This is for the subprocess call ( run_bitmessage() )
         self.enable_bm = 0
+        # Captures what the daemon prints ( run_bitmessage() )
+        self.daemon_output = None
+        # Set to a path to also keep the daemon output in a log file
+        self.daemon_log_file = None
+        # Set to a directory to deduplicate saved attachments in, otherwise
+        # ATTACHMENT_STORE_DIR next to keys.dat is used if it's there
+        self.attachment_store_path = None
+        self.attachment_store = None
+        # Starts the daemon and restarts it if it dies
+        self.supervisor = DaemonSupervisor(self)
         self.api_import = False
+        # None until the first batch tells us if system.multicall works
+        self.multicall_supported = None
+        self.batch_size = BATCH_SIZE
+        self.api_workers = API_WORKERS
+        # Local copies of the mailboxes, kept up to date by sync_box()
+        self.message_stores = self.open_message_stores()
+        self.box_ids = {'inbox': [], 'outbox': []}
+        self.message_handles = {'inbox': MessageHandles(), 'outbox': MessageHandles()}
+        self.unread = UnreadCounter()
+        # Our addresses in keys.dat, as of the last unread reconciliation
+        self.identities = set()
+        # The last msgid refresh_read_flags() checked, it carries on after it
+        self.read_flags_checked = ''
+        self.address_index = AddressIndex()
+        self.address_book = ContactList()
+        self.subscriptions = ContactList()
         # Used for the self.api call and initial running of bitmessage
         self.first_run = True
+        # False when running a subcommand from the command line
+        self.interactive = True
+        # Where the API listens, set by return_api()
+        self.api_address = None
+        # What self.api was made with
+        self.api_url = None
+        # Made by workers_client() when a batch first needs it
+        self.bulk_client = None
+        # Seconds the API took to answer after the daemon was last started
+        self.time_to_ready = None
         self.commands = {'addinfo': self.add_info,
                          'apitest': self.api_test,
                          'bmsettings': self.bm_settings,
@@ -67,8 +1323,13 @@ class Bitmessage(object):
                          'read': self.read_something,
                          'save': self.save_message,
                          'delete': self.delete_message,
+                         'markread': self.mark_read,
+                         'markunread': self.mark_unread,
                          'markallmessagesunread': self.mark_all_messages_unread,
-                         'markallmessagesread': self.mark_all_messages_read}
+                         'markallmessagesread': self.mark_all_messages_read,
+                         'exportattachments': self.export_attachments,
+                         'daemonlog': self.daemon_log,
+                         'restartdaemon': self.restart_daemon}
         self.settings_options = {'daemon': 'boolean',
                                   'timeformat': '',
                                   'blackwhitelist': 'boolean',
@@ -107,9 +1368,57 @@ class Bitmessage(object):
                                   'willinglysendtomobile': '',
                                   'opencl': 'boolean'}
 
+    # An ApiClient for the same API this instance talks to, over the same
+    # transport
+    def api_client(self, max_in_flight=API_MAX_IN_FLIGHT):
+        return ApiClient(self.api_url or self.return_api(), max_in_flight, self.api_transport)
+
+
+    # The ApiClient bulk operations run their calls on. It's kept for every
+    # batch after, and only made again if the API or worker count changes.
+    def workers_client(self):
+        client = self.bulk_client
+        if client is None or client.api_url != self.api_url or len(client.workers) != self.api_workers:
+            if client is not None:
+                client.close()
+            client = self.bulk_client = self.api_client(self.api_workers)
+        return client
+
+
+    # Uses the on-disk cache when we can, otherwise keeps messages in memory
+    def open_message_stores(self):
+        if sqlite3 is not None:
+            cache_path = os.path.join(self.keys_path, MESSAGE_CACHE_FILE)
+            try:
+                return {'inbox': SqliteMessageStore(cache_path, 'inbox'),
+                        'outbox': SqliteMessageStore(cache_path, 'outbox')}
+            except sqlite3.Error as e:
+                print('Couldn\'t open the message cache ({0}), keeping messages in memory'.format(e))
+        return {'inbox': MessageStore(), 'outbox': MessageStore()}
+
+
+    # Returns the AttachmentStore to save attachments through, or None to
+    # save plain copies
+    def open_attachment_store(self):
+        path = self.attachment_store_path
+        if path is None:
+            path = os.path.join(self.keys_path, ATTACHMENT_STORE_DIR)
+            if not os.path.isdir(path):
+                return None
+        if self.attachment_store is None or self.attachment_store.path != path:
+            try:
+                self.attachment_store = AttachmentStore(path)
+            except (IOError, OSError) as e:
+                print('Couldn\'t open the attachment store ({0}), saving plain copies'.format(e))
+                return None
+        return self.attachment_store
+
+
     # Checks input for exit or quit, strips all input,
     # and catches keyboard exits
     def user_input(self, message):
+        if not self.interactive:
+            raise PromptRequired(message)
         try:
             print('\n{0}'.format(message))
             the_input = raw_input('> ').strip()
@@ -124,18 +1433,14 @@ class Bitmessage(object):
                 self.view_help()
                 self.main()
             else:
-                try:
-                    if self.enable_bm.poll() is not None:
-                        self.preparations()
-                        time.sleep(2.5)
-                except AttributeError:
-                    pass                  
                 return the_input
 
 
     def kill_program(self):
         try:
             print('Shutting down..')
+            # Don't bring the daemon back up while it's shutting down
+            self.supervisor.stop()
             self.api.shutdown()
             sys.exit(0)
         except(AttributeError, OSError, socket.error):
@@ -161,7 +1466,7 @@ class Bitmessage(object):
 
     def return_api(self):
         try:
-            CONFIG.read(self.keys_file)
+            self.load_config()
             api_username = CONFIG.get('bitmessagesettings', 'apiusername')
             api_password = CONFIG.get('bitmessagesettings', 'apipassword')
             api_interface = CONFIG.get('bitmessagesettings', 'apiinterface')
@@ -175,12 +1480,10 @@ class Bitmessage(object):
         except socket.error as e:
             self.api_import = False
         else:
-            if self.first_run:
-                # For whatever reason, the API doesn't connect right away unless
-                # we pause for 1 second or more.
-                # Not sure if it's a xmlrpclib or BM issue, but it's annoying.
-                time.sleep(2.5)
-                self.first_run = False
+            # The API doesn't answer right away after the daemon starts,
+            # preparations() waits for it with wait_for_api()
+            self.first_run = False
+            self.api_address = (api_interface, api_port)
             # Build the api credentials
             self.api_import = True
             return 'http://{0}:{1}@{2}:{3}/'.format(api_username,
@@ -206,7 +1509,7 @@ class Bitmessage(object):
                    ''.join([SECURE_RANDOM.choice(CHARACTERS) for x in range(0,64)]))
         CONFIG.set('bitmessagesettings', 'apipassword',
                    ''.join([SECURE_RANDOM.choice(CHARACTERS) for x in range(0,64)]))
-        CONFIG.set('bitmessagesettings', 'daemon', True)
+        CONFIG.set('bitmessagesettings', 'daemon', 'True')
         CONFIG.set('bitmessagesettings', 'timeformat', '%%c')
         CONFIG.set('bitmessagesettings', 'blackwhitelist', 'black')
         CONFIG.set('bitmessagesettings', 'startonlogon', 'False')
@@ -251,8 +1554,7 @@ class Bitmessage(object):
         CONFIG.set('bitmessagesettings', 'trayonclose', 'False')
         CONFIG.set('bitmessagesettings', 'willinglysendtomobile', 'False')
         CONFIG.set('bitmessagesettings', 'opencl', 'None')
-        with open(self.keys_file, 'w') as configfile:
-            CONFIG.write(configfile)
+        self.write_config()
         enable_proxy = self.user_input('Enable proxy (Y/n)?').lower()
         if enable_proxy in ['yes', 'y']:
             print('Proxy settings are:')
@@ -269,8 +1571,7 @@ class Bitmessage(object):
                         setting_input = self.user_input('Possibilities: \'none\', \'SOCKS4a\', \'SOCKS5\'').lower()
                         if setting_input in PROXY_TYPE_DICT.keys():                            
                             CONFIG.set('bitmessagesettings', 'socksproxytype', PROXY_TYPE_DICT[setting_input])
-                            with open(self.keys_file, 'w') as configfile:
-                                CONFIG.write(configfile)
+                            self.write_config()
                         else:
                             print('socksproxytype was not changed')
                             invalidInput = True
@@ -279,8 +1580,7 @@ class Bitmessage(object):
                             setting_input = int(self.user_input('Please input proxy port'))
                             if 1 <= setting_input <= 65535:
                                 CONFIG.set('bitmessagesettings', 'socksport', setting_input)
-                                with open(self.keys_file, 'w') as configfile:
-                                    CONFIG.write(configfile)
+                                self.write_config()
                             else:
                                 print('That\'s an invalid port number')
                         except ValueError:
@@ -289,8 +1589,7 @@ class Bitmessage(object):
                     elif setting_input == 'host':
                         setting_input = int(self.user_input('Please input proxy hostname'))
                         CONFIG.set('bitmessagesettings', 'sockshostname', setting_input)
-                        with open(self.keys_file, 'w') as configfile:
-                            CONFIG.write(configfile)
+                        self.write_config()
                     elif setting_input == '':
                         break
                     else:
@@ -310,71 +1609,75 @@ class Bitmessage(object):
             CONFIG.set('bitmessagesettings', 'socksproxytype', 'none')
         # Prevents Exit or Quit from overriding the proxy question
         CONFIG.set('bitmessagesettings', 'apienabled', 'True')
-        with open(self.keys_file, 'w') as configfile:
-            CONFIG.write(configfile)
+        self.write_config()
+
+
+    # Re-reads keys.dat, but only if it changed since we last read or wrote it
+    def load_config(self):
+        stamp = self.config_file_stamp()
+        if stamp is not None and stamp == self.config_stamp:
+            return False
+        CONFIG.read(self.keys_file)
+        self.config_stamp = stamp
+        return True
+
+
+    def config_file_stamp(self):
+        try:
+            file_info = os.stat(self.keys_file)
+        except OSError:
+            return None
+        return (file_info.st_mtime, file_info.st_size)
+
+
+    # Writes keys.dat through a temporary file that gets renamed over it,
+    # so the daemon never sees it half written. Skipped if nothing changed.
+    def write_config(self):
+        output = StringIO.StringIO()
+        CONFIG.write(output)
+        contents = output.getvalue()
+        try:
+            with open(self.keys_file, 'r') as configfile:
+                if configfile.read() == contents:
+                    return
+            file_mode = stat.S_IMODE(os.stat(self.keys_file).st_mode)
+        except (IOError, OSError):
+            file_mode = None
+        temp_file, temp_path = tempfile.mkstemp(prefix='.keys.dat.', dir=self.keys_path)
+        try:
+            with os.fdopen(temp_file, 'w') as configfile:
+                configfile.write(contents)
+                configfile.flush()
+                os.fsync(configfile.fileno())
+            if file_mode is not None:
+                os.chmod(temp_path, file_mode)
+            # Windows won't rename over an existing file
+            if sys.platform.startswith('win') and os.path.exists(self.keys_file):
+                os.remove(self.keys_file)
+            os.rename(temp_path, self.keys_file)
+        except (IOError, OSError):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.config_stamp = self.config_file_stamp()
 
 
     def api_data(self):
         try:
-            CONFIG.read(self.keys_file)
-            CONFIG.getint('bitmessagesettings', 'port')
-            CONFIG.getboolean('bitmessagesettings', 'apienabled')
-            CONFIG.getint('bitmessagesettings', 'settingsversion')
-            CONFIG.getint('bitmessagesettings', 'apiport')
-            CONFIG.get('bitmessagesettings', 'apiinterface')
-            CONFIG.get('bitmessagesettings', 'apiusername')
-            CONFIG.get('bitmessagesettings', 'apipassword')
-            CONFIG.getboolean('bitmessagesettings', 'daemon')
-            CONFIG.get('bitmessagesettings', 'timeformat')
-            CONFIG.get('bitmessagesettings', 'blackwhitelist')
-            CONFIG.getboolean('bitmessagesettings', 'startonlogon')
-            CONFIG.getboolean('bitmessagesettings', 'minimizetotray')
-            CONFIG.getboolean('bitmessagesettings', 'showtraynotifications')
-            CONFIG.getboolean('bitmessagesettings', 'startintray')
-            CONFIG.get('bitmessagesettings', 'sockshostname')
-            CONFIG.getint('bitmessagesettings', 'socksport')
-            CONFIG.getboolean('bitmessagesettings', 'socksauthentication')
-            CONFIG.getboolean('bitmessagesettings', 'sockslisten')
-            CONFIG.get('bitmessagesettings', 'socksusername')
-            CONFIG.get('bitmessagesettings', 'digestalg')
-            CONFIG.get('bitmessagesettings', 'sockspassword')
-            CONFIG.get('bitmessagesettings', 'socksproxytype')
-            CONFIG.getboolean('bitmessagesettings', 'keysencrypted')
-            CONFIG.getboolean('bitmessagesettings', 'messagesencrypted')
-            CONFIG.getint('bitmessagesettings', 'defaultnoncetrialsperbyte')
-            CONFIG.getint('bitmessagesettings', 'defaultpayloadlengthextrabytes')
-            CONFIG.getboolean('bitmessagesettings', 'minimizeonclose')
-            CONFIG.getint('bitmessagesettings', 'maxacceptablenoncetrialsperbyte')
-            CONFIG.getint('bitmessagesettings', 'maxacceptablepayloadlengthextrabytes')
-            CONFIG.get('bitmessagesettings', 'userlocale')
-            CONFIG.getboolean('bitmessagesettings', 'useidenticons')
-            CONFIG.get('bitmessagesettings', 'identiconsuffix')
-            CONFIG.getboolean('bitmessagesettings', 'replybelow')
-            CONFIG.getint('bitmessagesettings', 'maxdownloadrate')
-            CONFIG.getint('bitmessagesettings', 'maxuploadrate')
-            CONFIG.getint('bitmessagesettings', 'maxoutboundconnections')
-            CONFIG.getint('bitmessagesettings', 'ttl')
-            CONFIG.get('bitmessagesettings', 'stopresendingafterxdays')
-            CONFIG.get('bitmessagesettings', 'stopresendingafterxmonths')
-            CONFIG.get('bitmessagesettings', 'namecoinrpctype')
-            CONFIG.get('bitmessagesettings', 'namecoinrpchost')
-            CONFIG.get('bitmessagesettings', 'namecoinrpcuser')
-            CONFIG.get('bitmessagesettings', 'namecoinrpcpassword')
-            CONFIG.getint('bitmessagesettings', 'namecoinrpcport')
-            CONFIG.getboolean('bitmessagesettings', 'sendoutgoingconnections')
-            CONFIG.get('bitmessagesettings', 'onionhostname')
-            CONFIG.get('bitmessagesettings', 'onionbindip')
-            CONFIG.getboolean('bitmessagesettings', 'hidetrayconnectionnotifications')
-            CONFIG.getboolean('bitmessagesettings', 'trayonclose')
-            CONFIG.getboolean('bitmessagesettings', 'willinglysendtomobile')
-            CONFIG.get('bitmessagesettings', 'opencl')
-            CONFIG.set('bitmessagesettings', 'daemon', True)
-            with open(self.keys_file, 'w') as configfile:
-                CONFIG.write(configfile)
+            if not self.load_config() and self.config_valid:
+                return
+            for option, getter in COMPILED_SETTINGS_SCHEMA:
+                getter(CONFIG, 'bitmessagesettings', option)
+            if CONFIG.get('bitmessagesettings', 'daemon') != 'True':
+                CONFIG.set('bitmessagesettings', 'daemon', 'True')
+                self.write_config()
+            self.config_valid = True
         except ConfigParser.NoOptionError as e:
+            self.config_valid = False
             print("{0} and possibly others are missing.".format(str(e).split("'")[1]))
             self.config_init()
         except ConfigParser.NoSectionError:
+            self.config_valid = False
             print("No section 'bitmessagesettings'")
             self.config_init()
 
@@ -385,6 +1688,14 @@ class Bitmessage(object):
                 print('API connection test has: PASSED')
             else:
                 print('API connection test has: FAILED')
+            stats = self.api_transport.connection_stats()
+            print('API requests: {0}'.format(stats['requests']))
+            print('Connections opened: {0}'.format(stats['opened']))
+            print('Connections reused: {0}'.format(stats['reused']))
+            print('Idle connections: {0}'.format(stats['idle']))
+            alive, age = self.api_liveness()
+            if age is not None:
+                print('API last answered {0:.1f}s ago'.format(age))
         except socket.error:
             self.api_import = False
             return False
@@ -395,7 +1706,12 @@ class Bitmessage(object):
     def api_check(self):
         try:
             result = self.api.add(2,3)
-        except socket.error:
+        except xmlrpclib.ProtocolError as e:
+            if e.errcode == 401:
+                print(API_UNAUTHORIZED)
+            self.api_import = False
+            return False
+        except (socket.error, httplib.HTTPException, xmlrpclib.Error):
             self.api_import = False
             return False
         else:
@@ -405,6 +1721,66 @@ class Bitmessage(object):
                 return False
 
 
+    # Whether the API is up. Every successful API call counts as a
+    # heartbeat, so add(2,3) is only sent once the last one is older than
+    # API_LIVENESS_TTL or a connection error cleared it.
+    def api_alive(self):
+        age = self.api_transport.heartbeat_age()
+        if self.api_import and age is not None and age < API_LIVENESS_TTL:
+            return True
+        return self.api_check()
+
+
+    # The last known API state and how many seconds old it is
+    def api_liveness(self):
+        age = self.api_transport.heartbeat_age()
+        return (age is not None and age < API_LIVENESS_TTL, age)
+
+
+    # Checks the API port is accepting connections, which is much cheaper
+    # to fail than a full RPC while the daemon is still starting up.
+    def api_port_open(self):
+        if self.api_address is None:
+            return True
+        try:
+            probe = socket.create_connection(self.api_address, API_PROBE_MAX_DELAY)
+        except socket.error:
+            return False
+        probe.close()
+        return True
+
+
+    # Waits for the API to answer, probing the port and then the add RPC
+    # with exponential backoff. Returns as soon as the daemon answers,
+    # or False once the deadline passes.
+    def wait_for_api(self, timeout=API_READY_TIMEOUT):
+        started = time.time()
+        deadline = started + timeout
+        delay = API_PROBE_DELAY
+        while True:
+            try:
+                ready = self.api_port_open() and self.api.add(2,3) == 5
+            except xmlrpclib.ProtocolError as e:
+                # Waiting won't fix a wrong username or password
+                if e.errcode == 401:
+                    print(API_UNAUTHORIZED)
+                    return False
+                ready = False
+            except (socket.error, httplib.HTTPException, xmlrpclib.Error):
+                # Like a 5xx or a Fault while the daemon is still starting
+                ready = False
+            if ready:
+                self.time_to_ready = time.time() - started
+                print('API ready after {0:.2f}s'.format(self.time_to_ready))
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                print('API did not answer within {0:g}s'.format(timeout))
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, API_PROBE_MAX_DELAY)
+
+
     # Allows the viewing and modification of keys.dat settings.
     def bm_settings(self):
         # Read the keys.dat
@@ -446,28 +1822,70 @@ class Bitmessage(object):
                     invalid_input = True
                 # don't prompt if they made a mistake
                 if not invalid_input:
-                    with open(self.keys_file, 'w') as configfile:
-                        CONFIG.write(configfile)
-                        print('Changes made')
-                        self.current_settings()
+                    self.write_config()
+                    print('Changes made')
+                    self.current_settings()
                     change_another = self.user_input('Would you like to change another setting, (Y)/(n)').lower()
                     if change_another not in ['yes', 'y']:
                         break
 
 
+    # Checked locally, so this is cheap enough to call as often as we like
     def valid_address(self, address):
+        return decode_address(address)['status'] == 'success'
+
+
+    # Our addresses, only asking the API once the index has gone stale
+    def own_addresses(self):
+        if self.address_index.stale():
+            self.address_index.load(json.loads(self.api.listAddresses())['addresses'])
+        return self.address_index
+
+
+    # The address book and subscriptions, only fetched once they've gone stale
+    def address_book_entries(self):
+        if self.address_book.stale():
+            response = self.api.listAddressBookEntries()
+            if 'API Error' in response:
+                raise APIError(response)
+            self.address_book.load(json.loads(response)['addresses'])
+        return self.address_book
+
+
+    def subscription_entries(self):
+        if self.subscriptions.stale():
+            response = self.api.listSubscriptions()
+            if 'API Error' in response:
+                raise APIError(response)
+            self.subscriptions.load(json.loads(response)['subscriptions'])
+        return self.subscriptions
+
+
+    # Asks which of our addresses to send from, by address or label,
+    # unless there's only one to pick
+    def choose_from_address(self):
+        own_addresses = self.own_addresses()
+        if len(own_addresses.addresses) > 1:
+            while True:
+                from_address = self.user_input('Enter an Address or Address Label to send from')
+                address = own_addresses.resolve(from_address)
+                if address is not None:
+                    return address
+                if self.valid_address(from_address):
+                    print('The address entered is not one of yours. Please try again.')
+                else:
+                    print('Invalid Address. Please try again.')
         try:
-            address_information = json.loads(self.api.decodeAddress(address))
-        except AttributeError:
-            return False
-        except socket.error:
-            self.api_import = False
-            return False
+            from_address = own_addresses.addresses[0]['address']
+        # No address in the address book
+        except IndexError:
+            print('You don\'t have any addresses generated!')
+            print('Please use the \'generateaddress\' command')
+            self.main()
         else:
-            if address_information.get('status') == 'success':
-                return True
-            else:
-                return False
+            # Only one address in address book
+            print('Using the only address in the addressbook to send from.')
+            return from_address
 
     def get_address(self, passphrase, version_number, stream_number):
         try:
@@ -493,14 +1911,14 @@ class Bitmessage(object):
                     print('Not a valid address, please try again.')
             while True:
                 label = self.user_input('Enter a label for this address:')
-                label = base64.b64encode(label)
-                subscription_check = self.api.addSubscription(address, label)
+                subscription_check = self.api.addSubscription(address, base64.b64encode(label))
                 break
         except socket.error:
             self.api_import = False
             print('Couldn\'t subscribe to channel due to an API connection issue')
         else:
             if subscription_check == 'Added subscription.':
+                self.subscriptions.add({'address': address, 'label': label, 'enabled': True})
                 print('You are now subscribed to: {0}'.format(address))
             else:
                 print(subscription_check)
@@ -515,8 +1933,12 @@ class Bitmessage(object):
             while True:
                 unsubscribe_verify = self.user_input('Are you sure, (Y)/(n)').lower()
                 if unsubscribe_verify in ['yes', 'y']:
-                    a = self.api.deleteSubscription(address)
-                    print('You are now unsubscribed from: {0}'.format(address))
+                    response = self.api.deleteSubscription(address)
+                    if 'API Error' in response:
+                        print(response)
+                    else:
+                        self.subscriptions.remove(address)
+                        print('You are now unsubscribed from: {0}'.format(address))
                 else:
                     print("You weren't unsubscribed from anything.")
                 break
@@ -527,13 +1949,15 @@ class Bitmessage(object):
 
     def list_subscriptions(self):
         try:
-            total_subscriptions = json.loads(self.api.listSubscriptions())
+            subscriptions = self.subscription_entries()
             print('-------------------------------------')
-            for each in total_subscriptions['subscriptions']:
-                print('Label: {0}'.format(base64.b64decode(each['label'])))
+            for each in subscriptions.entries.itervalues():
+                print('Label: {0}'.format(each['label']))
                 print('Address: {0}'.format(each['address']))
                 print('Enabled: {0}'.format(each['enabled']))
                 print('-------------------------------------')
+        except APIError as e:
+            print(e)
         except socket.error:
             self.api_import = False
             print('Couldn\'t list subscriptions due to an API connection issue')
@@ -544,6 +1968,7 @@ class Bitmessage(object):
             password = self.user_input('Enter channel name:')
             password = base64.b64encode(password)
             print('Channel password: ' + self.api.createChan(password))
+            self.address_index.invalidate()
         except socket.error:
             self.api_import = False
             print('Couldn\'t create channel due to an API connection issue')
@@ -561,6 +1986,7 @@ class Bitmessage(object):
                     break
             password = base64.b64encode(password)
             joining_channel = self.api.joinChan(password, address)
+            self.address_index.invalidate()
             if joining_channel == 'success':
                 print('Successfully joined {0}'.format(address))
             # TODO - This should probably be done better
@@ -577,21 +2003,13 @@ class Bitmessage(object):
                 address = self.user_input('Enter Channel Address or Label:')
                 if self.valid_address(address):
                     break
-                else:
-                    json_addresses = json.loads(self.api.listAddresses())
-                    # Number of addresses
-                    number_of_addresses = len(json_addresses['addresses'])
-                    # processes all of the addresses and lists them out
-                    for each in range (0, number_of_addresses):
-                        label = json_addresses['addresses'][each]['label']
-                        single_address = json_addresses['addresses'][each]['address']
-                        if '[chan] {0}'.format(address) == label:
-                            address = single_address
-                            found = True
-                            break
-                if found:
+                chan_address = self.own_addresses().resolve(address, chan_names=True)
+                if chan_address is not None:
+                    address = chan_address
                     break
+                print('Invalid Address or Label. Please try again.')
             leaving_channel = self.api.leaveChan(address)
+            self.address_index.invalidate()
             if leaving_channel == 'success':
                 print('Successfully left {0}'.format(address))
             else:
@@ -606,6 +2024,7 @@ class Bitmessage(object):
         try:
             json_load_addresses = json.loads(self.api.listAddresses())
             json_addresses = json_load_addresses['addresses']
+            self.address_index.load(json_addresses)
 
             if not json_addresses:
                 print('You have no addresses!')
@@ -626,6 +2045,7 @@ class Bitmessage(object):
     def generate_address(self, label, deterministic, passphrase, number_of_addresses,
                          address_version_number, stream_number, ripe):
         try:
+            self.address_index.invalidate()
             # Generates a new address with the user defined label, non-deterministic
             if deterministic is False:
                 address_label = base64.b64encode(label)
@@ -642,44 +2062,31 @@ class Bitmessage(object):
 
     def delete_address(self):
         try:
-            json_load_addresses = json.loads(self.api.listAddresses())
-            json_addresses = json_load_addresses['addresses']
-            number_of_addresses = len(json_addresses['addresses'])
-
-            if not json_addresses:
+            own_addresses = self.own_addresses()
+            if not own_addresses.addresses:
                 print('You have no addresses!')
             else:
                 while True:
                     address = self.user_input('Enter Address or Label you wish to delete:')
-                    if self.valid_address(address):
+                    found = own_addresses.resolve(address)
+                    if found is None:
+                        print('That isn\'t one of your addresses. Please try again.')
+                        continue
+                    delete_this = self.api.deleteAddress(found)
+                    self.address_index.invalidate()
+                    if delete_this == 'success':
+                        print('{0} has been deleted!'.format(found))
                         break
                     else:
-                        # processes all of the addresses and lists them out
-                        for each in range (0, number_of_addresses):
-                            label = json_addresses['addresses'][each]['label']
-                            json_address = json_addresses['addresses'][each]['address']
-                            if '{0}'.format(address) == label:
-                                address = json_address
-                                found = True
-                                break
-                    if found:
-                        delete_this = self.api.deleteAddress(address)
-                        if delete_this == 'success':
-                            print('{0} has been deleted!'.format(address))
-                            break
-                        else:
-                            print('Couldn\'t delete address. Expected response of \'success\', got: {0}'.format(leaving_channel))
+                        print('Couldn\'t delete address. Expected response of \'success\', got: {0}'.format(delete_this))
         except socket.error:
             self.api_import = False
-            print('Couldn\'t delete address due to an API connection issue')      
+            print('Couldn\'t delete address due to an API connection issue')
 
 
     # Allows attachments and messages/broadcats to be saved
     def save_file(self, file_name, file_data):
-        # This section finds all invalid characters and replaces them with ~
-        filename_replacements = ["/", "\\", ":", "*", "?", "'", "<", ">", "|"]
-        for each in filename_replacements:
-            file_name = file_name.replace(each, '~')
+        file_name = safe_file_name(file_name)
         while True:
             directory = self.user_input('Where would you like to save the attachment?: ')
             if not os.path.isdir(directory):
@@ -692,169 +2099,97 @@ class Bitmessage(object):
                     if not directory.endswith('/'):
                         directory = directory + '/'
                 file_path = directory + file_name
+                store = self.open_attachment_store()
                 # Begin saving to file
                 try:
-                    with open(file_path, 'w') as outfile:
-                        outfile.write(base64.b64decode(file_data))
-                except IOError:
+                    if store is not None:
+                        sha256 = store.save(file_data, file_path)
+                    else:
+                        sha256 = save_base64(file_data, file_path)
+                except (IOError, OSError):
                     print("Failed to save the attachment. Choose another directory")
+                except ValueError as e:
+                    print("The attachment couldn't be decoded: {0}".format(e))
+                    break
                 else:
                     print('Successfully saved {0}'.format(file_path))
+                    print('SHA-256: {0}'.format(sha256))
                     break
 
 
     # Allows users to attach a file to their message or broadcast
-    def attachment(self):
+    # Asks for a file to attach to message, and returns the message
+    # base64 encoded for the API, with the attachment if it's wanted
+    def attachment(self, message):
         while True:
-            is_image = False
-            the_attachment = ''
             file_path = self.user_input('Please enter the path to the attachment')
             if os.path.isfile(file_path):
                 break
             else:
                 print('{0} was not found on your filesystem or can not be opened.'.format(file_path))
 
-        while True:
-            # Get filesize and Converts to kilobytes
-            attachment_size = os.path.getsize(file_path) / 1024.0
-            # Rounds to two decimal places
-            round(attachment_size, 2)
-
-            # If over 200KB
-            if attachment_size > 200.0:
-                print('WARNING: The maximum message size including attachments, body, and headers is 256KB.')
-                print("If you reach over this limit, your message won't send.")
-                print("Your current attachment is {0}".format(attachment_size))
-                verify_attachment_200kb_warning = self.user_input('Are you sure you still want to attach it, (Y)/(n)').lower()
-
-                if verify_attachment_200kb_warning not in ['yes', 'y']:
-                    print('Attachment discarded.')
-                    return ''
-
-            # If larger than 256KB, discard
-            if attachment_size > 256.0:
-                print('Attachment too big, maximum allowed message size is 256KB')
-                return ''
-            break
-
-        # reads the filename
-        file_name = os.path.basename(file_path)
         # Tests if it is an image file
-        file_type = imghdr.what(file_path)
-        if file_type is not None:
+        is_image = imghdr.what(file_path) is not None
+        encoder = AttachmentEncoder(message, file_path, is_image)
+        # Message size including the encoded attachment, in kilobytes
+        message_size = round(encoder.message_size() / 1024.0, 2)
+
+        # If larger than 256KB, discard
+        if encoder.message_size() > MAX_MESSAGE_SIZE:
+            print('Attachment too big, maximum allowed message size is 256KB')
+            print('Your message with the attachment encoded is {0}KB'.format(message_size))
+            return base64.b64encode(message)
+
+        # If over 200KB
+        if encoder.message_size() > MESSAGE_SIZE_WARNING:
+            print('WARNING: The maximum message size including attachments, body, and headers is 256KB.')
+            print("If you reach over this limit, your message won't send.")
+            print('Your message with the attachment encoded is {0}KB'.format(message_size))
+            verify_attachment_200kb_warning = self.user_input('Are you sure you still want to attach it, (Y)/(n)').lower()
+
+            if verify_attachment_200kb_warning not in ['yes', 'y']:
+                print('Attachment discarded.')
+                return base64.b64encode(message)
+
+        if is_image:
             print('------------------------------------------')
             print('     Attachment detected as an Image.')
             print('<img> tags will be automatically included.')
             print('------------------------------------------\n')
-            is_image = True
-
-        print('Reading file...')
-        with open(filePath, 'rb') as f:
-            # Reads files up to 256KB
-            file_data = f.read(262144)
-            file_data = base64.b64encode(file_data)
 
-        # Alert the user that the encoding process may take some time
         print('Encoding attachment, please wait ...')
-        # Begin the actual encoding
-        # If it is an image, include image tags in the message
-        if isImage:
-            the_attachment = '<!-- Note: Base64 encoded image attachment below. -->\n\n'
-            the_attachment += 'Filename:{0}\n'.format(file_name)
-            the_attachment += 'Filesize:{0}KB\n'.format(attachment_size)
-            the_attachment += 'Encoding:base64\n\n'
-            the_attachment += '<center>\n'
-            the_attachment += "<img alt = \"{0}\" src='data:image/{0};base64, {1}' />\n".format(file_name, file_data)
-            the_attachment += '</center>'
-        # Else it is not an image so do not include the embedded image code.
-        else:
-            the_attachment = '<!-- Note: Base64 encoded file attachment below. -->\n\n'
-            the_attachment += 'Filename:{0}\n'.format(file_name)
-            the_attachment += 'Filesize:{0}KB\n'.format(attachment_size)
-            the_attachment += 'Encoding:base64\n\n'
-            the_attachment += '<center>\n'
-            the_attachment += "<attachment alt = \"{0}\" src='data:file/{0};base64, {1}' />\n".format(file_name, data)
-            the_attachment += '</center>'
-        return the_attachment
+        return encoder.encode()
 
 
     # With no arguments sent, send_message fills in the blanks
-    # subject and message must be encoded before they are passed
+    # subject must be encoded before it's passed, message is plain text
     def send_message(self, to_address, from_address, subject, message):
         try:
-            # TODO - Was using .encode('UTF-8'), not needed?
-            json_addresses = json.loads(self.api.listAddresses())
-            # Number of addresses
-            number_of_addresses = len(json_addresses['addresses'])
-
             if not self.valid_address(to_address):
-                found = False
+                # Cleared if the labels can't be fetched, then only an
+                # address will do
+                use_labels = True
                 while True:
                     to_address = self.user_input('What is the To Address?')
                     if self.valid_address(to_address):
                         break
-                    else:
-                        for each in range (0, number_of_addresses):
-                            label = json_addresses['addresses'][each]['label']
-                            address = json_addresses['addresses'][each]['address']
-                            if label.startswith('[chan] '):
-                                label = label.split('[chan] ')[1]
-                            # address entered was a label and is found
-                            elif to_address == label:
-                                found = True
-                                to_address = address
-                                break
-                        if not found:
-                            print('Invalid Address. Please try again.')
-                        else:
-                            break
+                    # address entered was a label and is found
+                    address = None
+                    if use_labels:
+                        try:
+                            address = self.address_book_entries().resolve(to_address)
+                            if address is None:
+                                address = self.own_addresses().resolve(to_address)
+                        except APIError as e:
+                            print('Couldn\'t look up labels: {0}'.format(e))
+                            use_labels = False
+                    if address is not None:
+                        to_address = address
+                        break
+                    print('Invalid Address. Please try again.')
 
             if not self.valid_address(from_address):
-                # Ask what address to send from if multiple addresses
-                if number_of_addresses > 1:
-                    found = False
-                    while True:
-                        from_address = self.user_input('Enter an Address or Address Label to send from')
-
-                        if not self.valid_address(from_address):
-                            # processes all of the addresses
-                            for each in range (0, number_of_addresses):
-                                label = jsonAddresses['addresses'][each]['label']
-                                address = jsonAddresses['addresses'][each]['address']
-                                if label.startswith('[chan] '):
-                                    label = label.split('[chan] ')[1]
-                                # address entered was a label and is found
-                                if fromAddress == label:
-                                    found = True
-                                    fromAddress = address
-                                    break
-                            if not found:
-                                print('Invalid Address. Please try again.')
-                        else:
-                            for each in range (0, number_of_addresses):
-                                address = json_addresses['addresses'][each]['address']
-                                # address entered was found in our address book
-                                if from_address == address:
-                                    found = True
-                                    break
-                            if not found:
-                                print('The address entered is not one of yours. Please try again.')
-                            else:
-                                break
-                        if found:
-                            break
-                else:
-                    try:
-                        from_address = json_addresses['addresses'][0]['address']
-                    # No address in the address book
-                    except IndexError:
-                        print('You don\'t have any addresses generated!')
-                        print('Please use the \'generateaddress\' command')
-                        self.main()
-                    else:
-                        # Only one address in address book
-                        print('Using the only address in the addressbook to send from.')
-
+                from_address = self.choose_from_address()
 
             if subject == '':
                 subject = self.user_input('Enter your subject')
@@ -866,8 +2201,9 @@ class Bitmessage(object):
             add_attachment = self.user_input('Would you like to add an attachment, (Y)/(n)').lower()
 
             if add_attachment in ['yes', 'y']:
-                message = '{0}\n\n{1}'.format(message, self.attachment())
-            message = base64.b64encode(message)
+                message = self.attachment(message)
+            else:
+                message = base64.b64encode(message)
 
             ack_data = self.api.sendMessage(to_address, from_address, subject, message)
             sending_message = self.api.getStatus(ack_data)
@@ -884,56 +2220,7 @@ class Bitmessage(object):
     def send_broadcast(self, from_address, subject, message):
         try:
             if from_address == '':
-                # TODO - Was using .encode('UTF-8'), not needed?
-                json_addresses = json.loads(self.api.listAddresses())
-                # Number of addresses
-                number_of_addresses = len(json_addresses['addresses'])
-
-                # Ask what address to send from if multiple addresses
-                if number_of_addresses > 1:
-                    found = False
-                    while True:
-                        from_address = self.user_input('Enter an Address or Address Label to send from')
-
-                        if not self.valid_address(from_address):
-                            # processes all of the addresses
-                            for each in range (0, number_of_addresses):
-                                label = json_addresses['addresses'][each]['label']
-                                address = json_addresses['addresses'][each]['address']
-                                if label.startswith('[chan] '):
-                                    label = label.split('[chan] ')[1]
-                                # address entered was a label and is found
-                                if from_address == label:
-                                    found = True
-                                    from_address = address
-                                    break
-                            if not found:
-                                print('Invalid Address. Please try again.')
-                        else:
-                            for each in range (0, number_of_addresses):
-                                address = json_addresses['addresses'][each]['address']
-                                # address entered was found in our address book
-                                if from_address == address:
-                                    found = True
-                                    break
-                            if not found:
-                                print('The address entered is not one of yours. Please try again.')
-                            else:
-                                # Address was found
-                                break
-                        if found:
-                            break
-                else:
-                    try:
-                        from_address = json_addresses['addresses'][0]['address']
-                    # No address in the address book!
-                    except IndexError:
-                        print('You don\'t have any addresses generated!')
-                        print('Please use the \'generateaddress\' command')
-                        self.main()
-                    else:
-                        # Only one address in address book
-                        print('Using the only address in the addressbook to send from.')
+                from_address = self.choose_from_address()
 
             if subject == '':
                     subject = self.user_input('Enter your Subject.')
@@ -943,8 +2230,9 @@ class Bitmessage(object):
 
             add_attachment = self.user_input('Would you like to add an attachment, (Y)/(n)').lower()
             if add_attachment in ['yes', 'y']:
-                message = message + '\n\n' + self.attachment()
-            message = base64.b64encode(message)
+                message = self.attachment(message)
+            else:
+                message = base64.b64encode(message)
 
             ack_data = self.api.sendBroadcast(from_address, subject, message)
             sending_message = self.api.getStatus(ack_data)
@@ -962,23 +2250,26 @@ class Bitmessage(object):
     # From Address Label, Subject, Received Time
     def inbox(self, unread_only):
         try:
-            inbox_messages = json.loads(self.api.getAllInboxMessages())
+            inbox_messages = self.box_messages('inbox')
+            if unread_only:
+                inbox_messages = self.refresh_unread(inbox_messages)
         except socket.error:
             self.api_import = False
             print('Couldn\'t access inbox due to an API connection issue')
-        else:        
-            total_messages = len(inbox_messages['inboxMessages'])
+        else:
+            handles = self.message_handles['inbox']
+            total_messages = len(inbox_messages)
             messages_printed = 0
             messages_unread = 0
             # processes all of the messages in the inbox
             for each in range (0, total_messages):
-                message = inbox_messages['inboxMessages'][each]
+                message = inbox_messages[each]
                 # if we are displaying all messages or
                 # if this message is unread then display it
                 if not unread_only or not message['read']:
                     print('-----------------------------------')
                     # Message Number
-                    print('Message Number: {0}'.format(each))
+                    print('Message Number: {0}'.format(handles.handle(message['msgid'])))
                     # Get the to address
                     print('To: {0}'.format(message['toAddress']))
                     # Get the from address
@@ -996,14 +2287,14 @@ class Bitmessage(object):
 
     def outbox(self):
         try:
-            outbox_messages = json.loads(self.api.getAllSentMessages())
-            json_outbox = outbox_messages['sentMessages']
+            json_outbox = self.box_messages('outbox')
+            handles = self.message_handles['outbox']
             total_messages = len(json_outbox)
             # processes all of the messages in the outbox
             for each in range(0, total_messages):
                 print('-----------------------------------')
                 # Message Number
-                print('Message Number: {0}'.format(each))
+                print('Message Number: {0}'.format(handles.handle(json_outbox[each]['msgid'])))
                 # Get the to address
                 print('To: {0}'.format(json_outbox[each]['toAddress']))
                 # Get the from address
@@ -1024,56 +2315,53 @@ class Bitmessage(object):
 
 
     # Opens a sent message for reading
-    def read_sent_message(self, message_number):
+    def read_sent_message(self, message_id):
         try:
-            outbox_messages = json.loads(self.api.getAllSentMessages())
-            total_messages = len(outbox_messages['sentMessages'])
-            if message_number >= total_messages:
+            sent_message = self.fetch_message('outbox', message_id)
+            if sent_message is None:
                 print('Invalid Message Number')
-                self.main()
+                return None
 
-            message = base64.b64decode(outbox_messages['sentMessages'][message_number]['message'])
-            self.detect_attachment(message)
+            message = self.detect_attachment(base64.b64decode(sent_message['message']))
 
             # Get the to address
-            print('To: {0}'.format(outbox_messages['sentMessages'][message_number]['toAddress']))
+            print('To: {0}'.format(sent_message['toAddress']))
             # Get the from address
-            print('From: {0}'.format(outbox_messages['sentMessages'][message_number]['fromAddress']))
+            print('From: {0}'.format(sent_message['fromAddress']))
             # Get the subject
-            print('Subject: {0}'.format(base64.b64decode(outbox_messages['sentMessages'][message_number]['subject'])))
+            print('Subject: {0}'.format(base64.b64decode(sent_message['subject'])))
             #Get the status
-            print('Status: {0}'.format(outbox_messages['sentMessages'][message_number]['status']))
-            last_action_time = datetime.datetime.fromtimestamp(float(outbox_messages['sentMessages'][message_number]['lastActionTime']))
+            print('Status: {0}'.format(sent_message['status']))
+            last_action_time = datetime.datetime.fromtimestamp(float(sent_message['lastActionTime']))
             print('Last Action Time: {0}'.format(last_action_time.strftime('%Y-%m-%d %H:%M:%S')))
             print('Message: {0}'.format(message))
+            return sent_message
         except socket.error:
             self.api_import = False
             print('Couldn\'t access outbox due to an API connection issue')
 
 
-    # Opens a message for reading
-    def read_message(self, message_number):
+    # Opens a message for reading, and returns it so it can be replied to
+    def read_message(self, message_id):
         try:
-            inbox_messages = json.loads(self.api.getAllInboxMessages())
-            total_messages = len(inbox_messages['inboxMessages'])
-            if message_number >= total_messages:
+            inbox_message = self.fetch_message('inbox', message_id)
+            if inbox_message is None:
                 print('Invalid Message Number.')
-                self.main()
+                return None
 
-            message = base64.b64decode(inbox_messages['inboxMessages'][message_number]['message'])
-            self.detect_attachment(message)
+            message = self.detect_attachment(base64.b64decode(inbox_message['message']))
 
             # Get the to address
-            print('To: {0}'.format(inbox_messages['inboxMessages'][message_number]['toAddress']))
+            print('To: {0}'.format(inbox_message['toAddress']))
             # Get the from address
-            print('From: {0}'.format(inbox_messages['inboxMessages'][message_number]['fromAddress']))
+            print('From: {0}'.format(inbox_message['fromAddress']))
             # Get the subject
-            print('Subject: {0}'.format(base64.b64decode(inbox_messages['inboxMessages'][message_number]['subject'])))
+            print('Subject: {0}'.format(base64.b64decode(inbox_message['subject'])))
 
-            received_time = datetime.datetime.fromtimestamp(float(inbox_messages['inboxMessages'][message_number]['receivedTime']))
+            received_time = datetime.datetime.fromtimestamp(float(inbox_message['receivedTime']))
             print('Received: {0}'.format(received_time.strftime('%Y-%m-%d %H:%M:%S')))
             print('Message: {0}'.format(message))
-            return inbox_messages['inboxMessages'][message_number]['msgid']
+            return inbox_message
         except socket.error:
             self.api_import = False
             print('Couldn\'t access inbox due to an API connection issue')
@@ -1081,19 +2369,17 @@ class Bitmessage(object):
 
     # Allows you to reply to the message you are currently on.
     # Saves typing in the addresses and subject.
-    def reply_message(self, message_number, forward_or_reply):
+    def reply_message(self, inbox_message, forward_or_reply):
         try:
-            inboxMessages = json.loads(self.api.getAllInboxMessages())
             # Address it was sent To, now the From address
-            from_address = inboxMessages['inboxMessages'][message_number]['toAddress']
+            from_address = inbox_message['toAddress']
             # Message that you are replying to
-            message = base64.b64decode(inboxMessages['inboxMessages'][message_number]['message'])
-            subject = inboxMessages['inboxMessages'][message_number]['subject']
-            subject = base64.b64decode(subject)
+            message = base64.b64decode(inbox_message['message'])
+            subject = base64.b64decode(inbox_message['subject'])
 
             if forward_or_reply == 'reply':
                 # Address it was From, now the To address
-                to_address = inboxMessages['inboxMessages'][message_number]['fromAddress']
+                to_address = inbox_message['fromAddress']
                 subject = 'Re: {0}'.format(subject)
             elif forward_or_reply == 'forward':
                 subject = 'Fwd: {0}'.format(subject)
@@ -1108,14 +2394,10 @@ class Bitmessage(object):
                 return
             subject = base64.b64encode(subject)
             new_message = self.user_input('Enter your Message.')
-
-            add_attachment = self.user_input('Would you like to add an attachment, (Y)/(n)').lower()
-            if add_attachment in ['yes', 'y']:
-                new_message = new_message + '\n\n' + self.attachment()
             new_message = new_message + '\n\n' + '-' * 55 + '\n'
             new_message = new_message + message
-            new_message = base64.b64encode(new_message)
 
+            # send_message encodes the message and offers to add an attachment
             self.send_message(to_address, from_address, subject, new_message)
         except socket.error:
             self.api_import = False
@@ -1123,13 +2405,11 @@ class Bitmessage(object):
 
 
     # Deletes a specified message from the outbox
-    def delete_sent_message(self, message_number):
+    def delete_sent_message(self, message_id):
         try:
-            outbox_messages = json.loads(self.api.getAllSentMessages())
-            # gets the message ID via the message index number
-            # TODO - message_number is wrapped in an int(), needed?
-            message_id = outbox_messages['sentMessages'][int(message_number)]['msgid']
             message_ack = self.api.trashSentMessage(message_id)
+            if 'API Error' not in message_ack:
+                self.forget_messages('outbox', [message_id])
             return message_ack
         except socket.error:
             self.api_import = False
@@ -1138,18 +2418,17 @@ class Bitmessage(object):
 
     def list_address_book(self):
         try:
-            response = self.api.listAddressBookEntries()
-            if 'API Error' in response:
-                return self.get_api_error_code(response)
-            address_book = json.loads(response)
-            if address_book['addresses']:
+            address_book = self.address_book_entries()
+            if address_book.entries:
                 print('-------------------------------------')
-                for each in address_book['addresses']:
-                    print('Label: {0}'.format(base64.b64decode(each['label'])))
+                for each in address_book.entries.itervalues():
+                    print('Label: {0}'.format(each['label']))
                     print('Address: {0}'.format(each['address']))
                     print('-------------------------------------')
             else:
                 print('No addresses found in address book.')
+        except APIError as e:
+            return e.code
         except socket.error:
             self.api_import = False
             print('Couldn\'t access address book due to an API connection issue')
@@ -1160,6 +2439,7 @@ class Bitmessage(object):
             response = self.api.addAddressBookEntry(address, base64.b64encode(label))
             if 'API Error' in response:
                 return self.get_api_error_code(response)
+            self.address_book.add({'address': address, 'label': label})
         except socket.error:
             self.api_import = False
             print('Couldn\'t add to address book due to an API connection issue')
@@ -1172,11 +2452,122 @@ class Bitmessage(object):
             return int(response.split()[2][:-1])
 
 
+    # Runs one API method over a list of argument tuples. Calls are grouped
+    # into system.multicall requests of self.batch_size, or spread over
+    # self.api_workers connections if the daemon doesn't support multicall.
+    # Returns (args, result, error) for each call, in the order given.
+    # After a Ctrl-C the calls that weren't done have CALL_CANCELLED as
+    # their error, see batch_cancelled().
+    def batch_call(self, method_name, args_list):
+        results = []
+        start = 0
+        try:
+            while start < len(args_list) and self.multicall_supported is not False:
+                chunk = args_list[start:start + self.batch_size]
+                chunk_results = self.multicall_chunk(method_name, chunk)
+                if chunk_results is None:
+                    break
+                results.extend(chunk_results)
+                start += len(chunk)
+            if start < len(args_list):
+                results.extend(self.parallel_call(method_name, args_list[start:]))
+        except KeyboardInterrupt:
+            # A multicall that was interrupted may still have gone through,
+            # the next sync picks up whatever it did
+            results.extend((args, None, CALL_CANCELLED) for args in args_list[len(results):])
+        return results
+
+
+    # Runs the calls on self.api_workers threads at once, so a thousand
+    # calls take about a thousand round trips / workers. The speedup comes
+    # from the calls overlapping, not from reusing connections, which the
+    # daemon closes after each call anyway.
+    def parallel_call(self, method_name, args_list):
+        if self.api_workers <= 1 or len(args_list) <= 1:
+            return self.sequential_chunk(method_name, args_list)
+        return self.workers_client().map(method_name, args_list)
+
+
+    def multicall_chunk(self, method_name, chunk):
+        calls = [{'methodName': method_name, 'params': list(args)} for args in chunk]
+        try:
+            responses = self.api.system.multicall(calls)
+        except xmlrpclib.Fault:
+            responses = None
+        # Bitmessage answers unknown methods with an 'API Error' string
+        if not isinstance(responses, list) or len(responses) != len(chunk):
+            self.multicall_supported = False
+            return None
+        self.multicall_supported = True
+        results = []
+        for args, response in zip(chunk, responses):
+            if isinstance(response, dict):
+                results.append((args, None, response.get('faultString')))
+            else:
+                results.append(self.batch_result(args, response[0]))
+        return results
+
+
+    def sequential_chunk(self, method_name, chunk):
+        results = []
+        for args in chunk:
+            try:
+                response = getattr(self.api, method_name)(*args)
+            except xmlrpclib.Fault as e:
+                results.append((args, None, e.faultString))
+            except KeyboardInterrupt:
+                results.extend((each, None, CALL_CANCELLED) for each in chunk[len(results):])
+                break
+            else:
+                results.append(self.batch_result(args, response))
+        return results
+
+
+    def batch_result(self, args, response):
+        if isinstance(response, basestring) and 'API Error' in response:
+            return (args, None, response)
+        return (args, response, None)
+
+
+    # Prints the failures of a batch_call and returns how many succeeded
+    def report_batch(self, results):
+        succeeded = 0
+        cancelled = 0
+        for args, result, error in results:
+            if error is None:
+                succeeded += 1
+            elif error == CALL_CANCELLED:
+                cancelled += 1
+            else:
+                print('{0}: {1}'.format(args[0], error))
+        if cancelled:
+            print('Cancelled {0} calls'.format(cancelled))
+        return succeeded
+
+
+    # Returns the addresses that aren't valid
+    def invalid_addresses(self, addresses):
+        return [each for each in addresses if not self.valid_address(each)]
+
+
+    # Records a read flag we changed in the cache and the unread counts
+    def set_read(self, message_id, read):
+        store = self.message_stores['inbox']
+        store.set_read(message_id, read)
+        to_address = None
+        if not read:
+            message = store.get(message_id)
+            if message is not None:
+                to_address = message['toAddress']
+        self.unread.set_read(message_id, read, to_address)
+
+
     def mark_message_read(self, message_id):
         try:
             response = self.api.getInboxMessageByID(message_id, True)
             if 'API Error' in response:
                 return self.get_api_error_code(response)
+            self.set_read(message_id, True)
         except socket.error:
             self.api_import = False
             print('Couldn\'t mark message as read due to an API connection issue')
@@ -1187,17 +2578,34 @@ class Bitmessage(object):
             response = self.api.getInboxMessageByID(message_id, False)
             if 'API Error' in response:
                return self.get_api_error_code(response)
+            self.set_read(message_id, False)
         except socket.error:
             self.api_import = False
             print('Couldn\'t mark message as unread due to an API connection issue')
 
 
+    def mark_read(self):
+        message_id = self.ask_message_id('inbox', 'mark read')
+        if self.mark_message_read(message_id) is None and self.api_import:
+            print('Marked {0} read.'.format(message_id))
+
+
+    def mark_unread(self):
+        message_id = self.ask_message_id('inbox', 'mark unread')
+        if self.mark_message_unread(message_id) is None and self.api_import:
+            print('Marked {0} unread.'.format(message_id))
+
+
     def mark_all_messages_read(self):
         try:
-            inbox_messages = json.loads(self.api.getAllInboxMessages())['inboxMessages']
-            for message in inbox_messages:
-                if not message['read']:
-                    mark_message_read(message['msgid'])
+            inbox_messages = self.box_messages('inbox')
+            unread = [(message['msgid'], True) for message in inbox_messages if not message['read']]
+            results = self.batch_call('getInboxMessageByID', unread)
+            for args, result, error in results:
+                if error is None:
+                    self.set_read(args[0], True)
+            marked = self.report_batch(results)
+            print('Marked {0} of {1} messages read.'.format(marked, len(unread)))
         except socket.error:
             self.api_import = False
             print('Couldn\'t mark all messages read due to an API connection issue')
@@ -1205,118 +2613,451 @@ class Bitmessage(object):
 
     def mark_all_messages_unread(self):
         try:
-            inbox_messages = json.loads(self.api.getAllInboxMessages())['inboxMessages']
-            for message in inbox_messages:
-                if message['read']:
-                    mark_message_unread(message['msgid'])
+            inbox_messages = self.box_messages('inbox')
+            read = [(message['msgid'], False) for message in inbox_messages if message['read']]
+            results = self.batch_call('getInboxMessageByID', read)
+            for args, result, error in results:
+                if error is None:
+                    self.set_read(args[0], False)
+            marked = self.report_batch(results)
+            print('Marked {0} of {1} messages unread.'.format(marked, len(read)))
         except socket.error:
             self.api_import = False
             print('Couldn\'t mark all messages unread due to an API connection issue')
 
 
-    def delete_message(self):
+    # Saves the attachments of one inbox message into directory. They're
+    # named after the msgid and where they are in the message, so the same
+    # attachment always gets the same name and one that's already there
+    # can be skipped. With an AttachmentStore, data it already has isn't
+    # decoded or written again. Returns the files saved, their bytes, the
+    # files skipped, and the errors.
+    def export_message_attachments(self, message, directory, store=None):
+        saved = 0
+        saved_bytes = 0
+        skipped = 0
+        errors = []
         try:
+            body = base64.b64decode(message['message'])
+        except TypeError as e:
+            return saved, saved_bytes, skipped, ['{0}: {1}'.format(message['msgid'], e)]
+        view = memoryview(body)
+        found = 0
+        for number, attachment in enumerate(find_attachments(body), 1):
+            found = number
+            file_name = '{0}-{1}-{2}'.format(message['msgid'][:16], number, safe_file_name(attachment.file_name))
+            file_path = os.path.join(directory, file_name)
+            # save_base64 only renames a file into place once it's complete
+            if os.path.exists(file_path):
+                skipped += 1
+                continue
+            encoded = view[attachment.offset:attachment.offset + attachment.length]
+            try:
+                if store is not None:
+                    store.save(encoded, file_path)
+                else:
+                    save_base64(encoded, file_path)
+            except (IOError, OSError, ValueError) as e:
+                errors.append('{0}: {1}'.format(file_name, e))
+            else:
+                saved += 1
+                saved_bytes += os.path.getsize(file_path)
+        # Every data URI should have been found, don't let one go missing quietly
+        missed = body.count(';base64,') - found
+        if missed > 0:
+            errors.append('{0}: {1} attachment(s) couldn\'t be read'.format(message['msgid'], missed))
+        return saved, saved_bytes, skipped, errors
+
+
+    # Saves every attachment in the inbox into directory, with
+    # self.api_workers messages being decoded at once. The inbox comes
+    # from the local cache after syncing it, so only new messages are
+    # downloaded, and each worker takes one message from the cache at a
+    # time. Ctrl-C stops handing out messages and waits for the ones being
+    # saved. Returns the totals.
+    def export_inbox_attachments(self, directory):
+        self.sync_box('inbox')
+        store = self.message_stores['inbox']
+        attachment_store = self.open_attachment_store()
+        message_ids = Queue.Queue()
+        for each in self.box_ids['inbox']:
+            message_ids.put(each)
+        stopping = threading.Event()
+        lock = threading.Lock()
+        totals = {'messages': 0, 'files': 0, 'bytes': 0, 'skipped': 0, 'errors': [], 'cancelled': False}
+
+        def worker():
+            while not stopping.is_set():
+                try:
+                    message_id = message_ids.get_nowait()
+                except Queue.Empty:
+                    return
+                message = store.get(message_id)
+                if message is None:
+                    continue
+                saved, saved_bytes, skipped, errors = self.export_message_attachments(message,
+                                                                                          directory,
+                                                                                          attachment_store)
+                with lock:
+                    totals['messages'] += 1
+                    totals['files'] += saved
+                    totals['bytes'] += saved_bytes
+                    totals['skipped'] += skipped
+                    totals['errors'].extend(errors)
+
+        started = time.time()
+        threads = [threading.Thread(target=worker) for each in range(max(1, self.api_workers))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # Polled rather than joined, so Ctrl-C gets through
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(0.01)
+        except KeyboardInterrupt:
+            stopping.set()
+            totals['cancelled'] = True
+            for thread in threads:
+                thread.join()
+        totals['elapsed'] = time.time() - started
+        return totals
+
+
+    def export_summary(self, totals):
+        summary = 'Saved {0} attachments ({1} bytes) from {2} messages, skipped {3} already saved'.format(
+            totals['files'], totals['bytes'], totals['messages'], totals['skipped'])
+        if totals['elapsed'] > 0:
+            summary += ', in {0:.2f}s ({1:.1f} files/s, {2:.0f} bytes/s)'.format(totals['elapsed'],
+                                                                                totals['files'] / totals['elapsed'],
+                                                                                totals['bytes'] / totals['elapsed'])
+        return summary
+
+
+    def export_attachments(self):
+        while True:
+            directory = self.user_input('Where would you like to save the attachments?: ')
+            if os.path.isdir(directory):
+                break
+            print("That directory doesn't exist.")
+        try:
+            totals = self.export_inbox_attachments(directory)
+        except socket.error:
+            self.api_import = False
+            print('Couldn\'t export the attachments due to an API connection issue')
+            return
+        for each in totals['errors']:
+            print(each)
+        if totals['cancelled']:
+            print('Cancelled')
+        print(self.export_summary(totals))
+
+
+    def delete_message(self):
+        while True:
             which_box = self.user_input('Would you like to delete a message from the (I)nbox or (O)utbox?').lower()
             if which_box in ['inbox', 'i']:
-                self.delete_inbox_message2()
+                self.delete_messages('inbox')
+                break
             elif which_box in ['outbox', 'o']:
-                outbox_messages = json.loads(self.api.getAllSentMessages())
-                total_messages = len(outbox_messages['sentMessages'])
-                while True:
-                    message_number = self.user_input('Enter the number of the message you wish to delete or (A)ll to empty the outbox.').lower()
-                    try:
-                        if message_number in ['all', 'a'] or int(message_number) == total_messages:
-                            break
-                        elif int(message_number) >= total_messages:
-                            break
-                        else:
-                            print('Invalid input')
-                    except ValueError:
-                        print('Invalid input')
-                # Prevent accidental deletion
-                verify_deletion = self.user_input('Are you sure, (Y)/(n)').lower()
-                if verify_deletion in ['yes', 'y']:
-                    if message_number in ['all', 'a'] or int(message_number) == total_messages:
-                        # processes all of the messages in the outbox
-                        for message_number in range (0, total_messages):
-                            print('Deleting message {0} of {1}'.format(message_number+1, total_messages))
-                            self.delete_sent_message(0)
-                        print('Outbox is empty.')
-                    else:
-                        self.delete_sent_message(int(message_number))
-                    print('Notice: Message numbers may have changed.')
-        except socket.error:
-            self.api_import = False
-            print('Couldn\'t access outbox due to an API connection issue')
+                self.delete_messages('outbox')
+                break
+            else:
+                print('Invalid input')
 
 
-    def delete_inbox_message(self, message_number):
+    def delete_inbox_message(self, message_id):
         try:
-            inbox_messages = json.loads(self.api.getAllInboxMessages())
-            total_messages = len(inbox_messages['inboxMessages'])
-            # gets the message ID via the message index number
-            # TODO - message_number is wrapped in an int(), needed?
-            message_id = inbox_messages['inboxMessages'][message_number]['msgid']
             message_ack = self.api.trashInboxMessage(message_id)
+            if 'API Error' not in message_ack:
+                self.forget_messages('inbox', [message_id])
             return message_ack
         except socket.error:
             self.api_import = False
             print('Couldn\'t delete message due to an API connection issue')
 
 
-    def delete_inbox_message2(self):
-        try:
-            inbox_messages = json.loads(self.api.getAllInboxMessages())
-            total_messages = len(inbox_messages['inboxMessages'])
+    # Drops trashed messages from the cache and the message numbers
+    def forget_messages(self, box, message_ids):
+        self.message_stores[box].remove(message_ids)
+        if box == 'inbox':
+            self.unread.remove(message_ids)
+        self.message_handles[box].forget(message_ids)
+        gone = set(message_ids)
+        self.box_ids[box] = [each for each in self.box_ids[box] if each not in gone]
 
-            while True:
-                message_number = self.user_input('Enter the number of the message you wish to delete or (A)ll to empty the inbox.').lower()
-                try:
-                    if message_number in ['all', 'a'] or int(message_number) == total_messages:
-                        break
-                    elif int(message_number) >= total_messages:
-                        print('Invalid Message Number')
-                    elif int(message_number) <= numMessages:
-                        break
-                    else:
-                        print('Invalid input')
-                except ValueError:
-                    print('Invalid input')
-            # Prevent accidental deletion
-            delete_verify = self.user_input('Are you sure, (Y)/(n)').lower()
-
-            if delete_verify in ['yes', 'y']:
-                if message_number in ['all', 'a'] or int(message_number) == total_messages:
-                    # Processes all of the messages in the inbox
-                    for message_number in range (0, total_messages):
-                        print('Deleting message {0} of {1}'.format(message_number+1, total_messages))
-                        self.delete_inbox_message(0)
-                    print('Inbox is empty.')
+
+    # Fetches the msgid list of a box and numbers any new messages
+    def refresh_message_ids(self, box):
+        message_ids = self.message_ids(box)
+        self.box_ids[box] = message_ids
+        self.message_handles[box].update(message_ids)
+        return message_ids
+
+
+    # Fetches one message by msgid, however big the box is, and keeps the
+    # cache up to date with it. Returns None if there's no such message.
+    def fetch_message(self, box, message_id):
+        if box == 'inbox':
+            response = self.api.getInboxMessageByID(message_id)
+            key = 'inboxMessage'
+        else:
+            response = self.api.getSentMessageByID(message_id)
+            key = 'sentMessage'
+        if 'API Error' in response:
+            print(response)
+            return None
+        messages = json.loads(response)[key]
+        if not messages:
+            return None
+        self.message_stores[box].add(messages)
+        if box == 'inbox':
+            self.unread.update(messages)
+        return messages[0]
+
+
+    # Turns a message number or a msgid into a msgid. The msgid list is
+    # only fetched when the number isn't one we've handed out yet.
+    # Returns None for a number no message has, or text that isn't a msgid.
+    def message_id_for(self, box, text):
+        # Checked first, a msgid could be all digits
+        if MSGID_PATTERN.match(text):
+            return text.lower()
+        if not text.isdigit():
+            return None
+        message_id = self.message_handles[box].message_id(int(text))
+        if message_id is None:
+            self.refresh_message_ids(box)
+            message_id = self.message_handles[box].message_id(int(text))
+        return message_id
+
+
+    def ask_message_id(self, box, action='open'):
+        while True:
+            message_id = self.message_id_for(box, self.user_input('What is the number or msgid of the message '
+                                                                  'you wish to {0}?'.format(action)))
+            if message_id is not None:
+                return message_id
+            print('Invalid Message Number')
+
+
+    # Gets just the msgids of a box, in the same order
+    # getAllInboxMessages / getAllSentMessages list them
+    def message_ids(self, box):
+        if box == 'inbox':
+            response = json.loads(self.api.getAllInboxMessageIds())
+            return [each['msgid'] for each in response['inboxMessageIds']]
+        response = json.loads(self.api.getAllSentMessageIds())
+        return [each['msgid'] for each in response['sentMessageIds']]
+
+
+    # Downloads full messages by msgid, a batch at a time
+    def fetch_messages(self, box, message_ids):
+        if box == 'inbox':
+            method_name, key = 'getInboxMessageByID', 'inboxMessage'
+        else:
+            method_name, key = 'getSentMessageByID', 'sentMessage'
+        messages = []
+        for args, result, error in self.batch_call(method_name, [(each,) for each in message_ids]):
+            if error is None:
+                messages.extend(json.loads(result)[key])
+            else:
+                print('Couldn\'t fetch message {0}: {1}'.format(args[0], error))
+        return messages
+
+
+    # Brings the local copy of a box up to date with the daemon.
+    # Only the msgid list is downloaded, then just the messages we haven't
+    # seen (plus sent messages still in flight whose status has changed)
+    # are fetched. Messages that are gone get dropped.
+    def sync_box(self, box):
+        try:
+            self.sync_store(box)
+        except CACHE_ERRORS as e:
+            # Like when another process keeps the cache locked too long
+            self.drop_message_cache(e)
+            self.sync_store(box)
+
+
+    # Carries on with the messages in memory when the cache stops working
+    def drop_message_cache(self, error):
+        message = 'The message cache failed ({0}), keeping messages in memory'.format(error)
+        if self.interactive:
+            print(message)
+        else:
+            # Scripts may be reading JSON from stdout
+            self.script_error(message)
+        self.message_stores = {'inbox': MessageStore(), 'outbox': MessageStore()}
+        self.unread.reconciled = None
+
+
+    def sync_store(self, box):
+        store = self.message_stores[box]
+        message_ids = self.message_ids(box)
+        known_ids = store.known_ids()
+        gone = known_ids.difference(message_ids)
+        store.remove(gone)
+        wanted = [each for each in message_ids if each not in known_ids]
+        in_flight = []
+        if box == 'outbox':
+            # What's gone was just removed, so these are all still there
+            in_flight = store.in_flight()
+        if in_flight:
+            wanted.extend(self.changed_statuses(in_flight))
+        messages = []
+        if wanted:
+            messages = self.fetch_messages(box, wanted)
+            store.add(messages)
+        if box == 'inbox':
+            self.unread.remove(gone)
+            self.unread.update(messages)
+            if self.unread.stale():
+                self.refresh_read_flags(set(wanted), UNREAD_REFRESH_LIMIT)
+                self.unread.reconcile(store.unread_ids())
+        self.box_ids[box] = message_ids
+        self.message_handles[box].update(message_ids)
+
+
+    # Another client may have read messages we have cached as unread, and
+    # the cache outlives this process, so those are fetched again in one
+    # batch. Messages we just fetched are skipped. With a limit, only that
+    # many are checked, going on from the last one checked the time before,
+    # so they all get their turn.
+    def refresh_read_flags(self, skip, limit=None):
+        store = self.message_stores['inbox']
+        unread_ids = sorted(each for each in store.unread_ids() if each not in skip)
+        if limit is not None and len(unread_ids) > limit:
+            later = [each for each in unread_ids if each > self.read_flags_checked]
+            unread_ids = (later + unread_ids[:len(unread_ids) - len(later)])[:limit]
+        if unread_ids:
+            self.read_flags_checked = unread_ids[-1]
+            store.add(self.fetch_messages('inbox', unread_ids))
+
+
+    # Before unread messages are listed, all of their read flags are
+    # checked. Takes and returns the messages of the inbox.
+    def refresh_unread(self, inbox_messages):
+        unread_ids = [each['msgid'] for each in inbox_messages if not each['read']]
+        fresh = dict((each['msgid'], each) for each in self.fetch_messages('inbox', unread_ids))
+        store = self.message_stores['inbox']
+        store.add(fresh.values())
+        self.unread.reconcile(store.unread_ids())
+        return [fresh.get(each['msgid'], each) for each in inbox_messages]
+
+
+    # Asks for the status of each sent message by its ackdata, which is
+    # much less to download than the messages, and returns the msgids of
+    # the ones that changed
+    def changed_statuses(self, messages):
+        changed = []
+        without_ack_data = [message['msgid'] for message in messages if not message.get('ackData')]
+        messages = [message for message in messages if message.get('ackData')]
+        results = self.batch_call('getStatus', [(message['ackData'],) for message in messages])
+        for message, (args, result, error) in zip(messages, results):
+            if error is not None or result != message['status']:
+                changed.append(message['msgid'])
+        return without_ack_data + changed
+
+
+    # Returns the messages of a box in the order the daemon lists them
+    def box_messages(self, box):
+        self.sync_box(box)
+        messages = self.message_stores[box].get_many(self.box_ids[box])
+        return [messages[each] for each in self.box_ids[box] if each in messages]
+
+
+    # Turns input like "3", "1,4,7", "2-5" or msgids into a list of msgids.
+    # A range takes the message numbers in it that still have a message.
+    # Returns None if any part of the selection isn't valid.
+    def select_messages(self, selection, box):
+        handles = self.message_handles[box]
+        selected = []
+        for part in selection.replace(',', ' ').split():
+            # Checked before numbers like message_id_for() does, a msgid
+            # could be all digits
+            if MSGID_PATTERN.match(part):
+                if part.lower() not in handles.handles:
+                    return None
+                selected.append(part.lower())
+                continue
+            try:
+                if '-' in part:
+                    first, last = [int(each) for each in part.split('-', 1)]
                 else:
-                    # No need for a try/except since it was already verified up above!
-                    self.delete_inbox_message(message_number)
-                print('Notice: Message numbers may have changed.')
-        except socket.error:
-            self.api_import = False
-            print('Couldn\'t delete inbox message(s) due to an API connection issue')
+                    first = last = int(part)
+            except ValueError:
+                return None
+            found = [handles.message_id(each) for each in range(max(first, 0), min(last, handles.next_handle - 1) + 1)]
+            found = [each for each in found if each is not None]
+            if not found:
+                return None
+            selected.extend(found)
+        # Drop duplicates but keep the order they were given in
+        seen = set()
+        return [each for each in selected if not (each in seen or seen.add(each))]
+
+
+    # Trashes messages by msgid in batches, reporting progress as it goes
+    def trash_messages(self, box, message_ids):
+        if box == 'inbox':
+            method_name = 'trashInboxMessage'
+        else:
+            method_name = 'trashSentMessage'
+        total_messages = len(message_ids)
+        trashed = 0
+        started = time.time()
+        for start in range(0, total_messages, self.batch_size):
+            chunk = [(each,) for each in message_ids[start:start + self.batch_size]]
+            results = self.batch_call(method_name, chunk)
+            self.forget_messages(box, [args[0] for args, result, error in results if error is None])
+            trashed += self.report_batch(results)
+            if batch_cancelled(results):
+                break
+            print('Deleted {0} of {1} messages'.format(start + len(chunk), total_messages))
+        elapsed = time.time() - started
+        if elapsed > 0:
+            print('Deleted {0} messages in {1:.2f}s ({2:.1f} messages/s)'.format(trashed,
+                                                                                 elapsed,
+                                                                                 trashed / elapsed))
+        return trashed
 
 
-    def add_info(self):
+    def delete_messages(self, box):
         try:
+            message_ids = self.refresh_message_ids(box)
+            if not message_ids:
+                print('The {0} is empty.'.format(box))
+                return
             while True:
-                address = self.user_input('Enter the Bitmessage Address:')
-                address_information = json.loads(str(self.api.decodeAddress(address)))
-                if address_information['status'] == 'success':
-                    print('Address Version: {0}'.format(address_information['addressVersion']))
-                    print('Stream Number: {0}'.format(address_information['streamNumber']))
+                selection = self.user_input('Enter the number(s) or msgid(s) of the messages you wish to delete '
+                                            '(e.g. 1,4-7) or (A)ll to empty the {0}.'.format(box))
+                if selection.lower() in ['all', 'a']:
+                    selected = message_ids
                     break
-                else:
-                    print('Invalid address!')
-        except AttributeError:
-            print('Invalid address!')
+                selected = self.select_messages(selection, box)
+                if selected:
+                    break
+                print('Invalid input')
+            # Prevent accidental deletion
+            verify_deletion = self.user_input('Are you sure, (Y)/(n)').lower()
+            if verify_deletion in ['yes', 'y']:
+                self.trash_messages(box, selected)
+                if selected is message_ids:
+                    print('{0} is empty.'.format(box.capitalize()))
         except socket.error:
             self.api_import = False
-            print('Couldn\'t display address information due to an API connection issue')
+            print('Couldn\'t delete {0} message(s) due to an API connection issue'.format(box))
+
+
+    def add_info(self):
+        while True:
+            address = self.user_input('Enter the Bitmessage Address:')
+            address_information = decode_address(address)
+            if address_information['status'] == 'success':
+                print('Address Version: {0}'.format(address_information['addressVersion']))
+                print('Stream Number: {0}'.format(address_information['streamNumber']))
+                break
+            else:
+                print('Invalid address!')
 
 
     def send_something(self):
@@ -1339,52 +3080,7 @@ class Bitmessage(object):
                 break
             else:
                 print('Invalid input')
-        try:
-            message_number = int(self.user_input('What is the number of the message you wish to open?'))
-        except ValueError:
-            print("That's not a whole number")
-
-        if read_which in ['inbox', 'i']:
-            print('Loading...')
-            message_id = self.read_message(message_number)
-
-            verify_unread = self.user_input('Would you like to keep this message unread, (Y)/(n)').lower()
-            if verify_unread not in ['yes', 'y']:
-                self.mark_message_read(message_id)
-
-            while True:
-                do_which = self.user_input('Would you like to (D)elete, (F)orward or (R)eply?').lower()
-                if do_which in ['delete','d','forward','f','reply','r']:
-                    break
-                else:
-                    print('Invalid input')
-
-            if do_which in ['reply', 'r']:
-                print('Loading...')
-                self.reply_message(message_number,'reply')
-
-            elif do_which in ['forward', 'f']:
-                print('Loading...')
-                self.reply_message(message_number,'forward')
-
-            elif do_which in ['delete', 'd']:
-                # Prevent accidental deletion
-                verify_delete = self.user_input('Are you sure, (Y)/(n)').lower()
-                if verify_delete in ['yes', 'y']:
-                    delete_inbox_message(self, message_number)
-                    print('Message Deleted.')
- 
-        elif read_which in ['outbox', 'o']:
-            self.read_sent_message(message_number)
-            # Gives the user the option to delete the message
-            delete_this = self.user_input('Would you like to Delete this message, (Y)/(n)').lower()
-            if delete_this in ['yes', 'y']:
-                # Prevent accidental deletion
-                verify_delete = self.user_input('Are you sure, (Y)/(n)').lower()
-
-                if verify_delete in ['yes', 'y']:
-                    self.delete_sent_message(message_number)
-                    print('Message Deleted.')
+        self.open_message(read_which)
 
 
     def save_message(self):
@@ -1392,56 +3088,59 @@ class Bitmessage(object):
             which_box = self.user_input('Would you like to read a message from the (I)nbox or (O)utbox?').lower()
             if which_box in ['inbox', 'outbox', 'i', 'o']:
                 break
+        self.open_message(which_box)
 
-        while True:
-            try:
-                message_number = int(self.user_input('What is the number of the message you wish to open?'))
-            except ValueError:
-                print("That's not a whole number")
-            else:
-                break
-
-        if which_box in ['inbox', 'i']:
-            print('Loading...')
-            message_id = self.read_message(message_number)
-            keep_unread = self.user_input('Would you like to keep this message unread, (Y)/(n)').lower()
 
-            if keep_unread not in ['yes', 'y']:
-                self.mark_message_read(message_id)
+    # Reads a message, then offers to reply to, forward or delete it
+    def open_message(self, which_box):
+        try:
+            if which_box in ['inbox', 'i']:
+                message_id = self.ask_message_id('inbox')
+                print('Loading...')
+                message = self.read_message(message_id)
+                if message is None:
+                    return
 
-            while True:
-                message_options = self.user_input('Would you like to (D)elete, (F)orward or (R)eply?').lower()
-                if message_options in ['delete','d','forward','f','reply','r']:
-                    break
-                else:
-                    print('Invalid input')
+                keep_unread = self.user_input('Would you like to keep this message unread, (Y)/(n)').lower()
+                if keep_unread not in ['yes', 'y']:
+                    self.mark_message_read(message_id)
 
-            if message_options in ['reply', 'r']:
-                print('Loading...')
-                self.reply_message(message_number,'reply')
-            elif message_options in ['forward', 'f']:
-                print('Loading...')
-                self.reply_message(message_number,'forward')
-            elif message_options in ['delete', 'd']:
-                # Prevent accidental deletion
-                verify_delete = self.user_input('Are you sure, (Y)/(n)').lower()
+                while True:
+                    message_options = self.user_input('Would you like to (D)elete, (F)orward or (R)eply?').lower()
+                    if message_options in ['delete','d','forward','f','reply','r']:
+                        break
+                    else:
+                        print('Invalid input')
 
-                if verify_delete in ['yes', 'y']:
-                    self.delete_inbox_message(message_number)
-                    print('Message Deleted.')
- 
-        elif which_box in ['outbox', 'o']:
-            self.read_sent_message(message_number)
-            # Gives the user the option to delete the message
-            delete_question = self.user_input('Would you like to Delete this message, (Y)/(n)').lower()
+                if message_options in ['reply', 'r']:
+                    self.reply_message(message, 'reply')
+                elif message_options in ['forward', 'f']:
+                    self.reply_message(message, 'forward')
+                elif message_options in ['delete', 'd']:
+                    # Prevent accidental deletion
+                    verify_delete = self.user_input('Are you sure, (Y)/(n)').lower()
 
-            if delete_question in ['yes', 'y']:
-                # Prevent accidental deletion
-                verify_delete = self.user_input('Are you sure, (Y)/(n)').lower()
+                    if verify_delete in ['yes', 'y']:
+                        self.delete_inbox_message(message_id)
+                        print('Message Deleted.')
 
-                if verify_delete in ['yes', 'y']:
-                    self.delete_sent_message(message_number)
-                    print('Message Deleted.')
+            elif which_box in ['outbox', 'o']:
+                message_id = self.ask_message_id('outbox')
+                if self.read_sent_message(message_id) is None:
+                    return
+                # Gives the user the option to delete the message
+                delete_question = self.user_input('Would you like to Delete this message, (Y)/(n)').lower()
+
+                if delete_question in ['yes', 'y']:
+                    # Prevent accidental deletion
+                    verify_delete = self.user_input('Are you sure, (Y)/(n)').lower()
+
+                    if verify_delete in ['yes', 'y']:
+                        self.delete_sent_message(message_id)
+                        print('Message Deleted.')
+        except socket.error:
+            self.api_import = False
+            print('Couldn\'t open the message due to an API connection issue')
 
 
     def add_adress_book(self):
@@ -1477,30 +3176,31 @@ class Bitmessage(object):
             if 'API Error' in response:
                 return self.get_api_error_code(response)
             else:
+                self.address_book.remove(address)
                 return response
         except socket.error:
             self.api_import = False
             print('Couldn\'t delete from address book due to an API connection issue')
 
 
+    # Shown before every prompt, so it only talks to the daemon and reads
+    # keys.dat when the counts are due to be reconciled
     def unread_message_info(self):
-        try:
-            inbox_messages = json.loads(self.api.getAllInboxMessages())
-        except socket.error:
-            self.api_import = False
-            print('Can\'t retrieve unread messages due to an API connection issue')
-        else:
-            CONFIG.read(self.keys_file)
-            unread_messages = 0
-            for each in inbox_messages['inboxMessages']:
-                if not each['read']:
-                    if each['toAddress'] in CONFIG.sections():
-                        unread_messages += 1
-            # If the bitmessageheader is there, AND you have at least one address
-            if unread_messages >= 1 and len(CONFIG.sections()) >= 2:
-                print('\nYou have {0} unread message(s)'.format(unread_messages))
-            else:
+        if self.unread.stale():
+            try:
+                # Refreshes the read flags and reconciles the counts
+                self.sync_box('inbox')
+            except socket.error:
+                self.api_import = False
+                print('Can\'t retrieve unread messages due to an API connection issue')
                 return
+            self.load_config()
+            self.identities = set(CONFIG.sections())
+            self.identities.discard('bitmessagesettings')
+        unread_messages = self.unread.total(self.identities)
+        # If you have at least one address
+        if unread_messages >= 1 and self.identities:
+            print('\nYou have {0} unread message(s)'.format(unread_messages))
 
 
     def generate_deterministic(self):
@@ -1568,37 +3268,23 @@ class Bitmessage(object):
             self.generate_random()
 
 
-    # I hate how there's +7 and +9 being used.
-    # This could be done so much better
+    # Offers to save each attachment in a message, and returns the message
+    # with the attachment data left out so it can be read. An attachment
+    # is only decoded if it gets saved.
     def detect_attachment(self, message):
-        # Allows multiple messages to be downloaded/saved
-        while True:
-            # Found this text in the message, there is probably an attachment
-            if ';base64,' in message:
-                attachment_position = message.index(';base64,')
-                attachment_end_position = message.index("' />")
-                # We can get the filename too
-                if "alt = '" in message:
-                    # Finds position of the filename
-                    find_position = message.index('alt = "')
-                    # Finds the end position
-                    end_position = message.index('" src=')
-                    file_name = message[find_position+7:end_position]
-                else:
-                    find_position = attachment_position
-                    file_name = 'Attachment'
-
-                save_attachment = self.user_input('Attachment Detected. Would you like to save the attachment, (Y)/(n)').lower()
-                if save_attachment in ['yes', 'y']:
-                    # TODO - This is tacky and should be replaced
-                    attachment = message[attachment_position+9:end_position]
-                    self.save_file(file_name,attachment)
-
-                # TODO - This is also tacky and should also be replaced
-                message = '{0}~<Attachment data removed for easier viewing>~{1}'.format(message[:find_position],
-                                                                                        message[(attEndPos+4):])
-            else:
-                break
+        view = memoryview(message)
+        parts = []
+        position = 0
+        for attachment in find_attachments(message):
+            save_attachment = self.user_input('Attachment Detected: {0}. Would you like to save the attachment, '
+                                              '(Y)/(n)'.format(attachment.file_name)).lower()
+            if save_attachment in ['yes', 'y']:
+                self.save_file(attachment.file_name, view[attachment.offset:attachment.offset + attachment.length])
+            parts.append(message[position:attachment.offset])
+            parts.append('~<Attachment data removed for easier viewing>~')
+            position = attachment.offset + attachment.length
+        parts.append(message[position:])
+        return ''.join(parts)
 
 
     def view_help(self):
@@ -1642,11 +3328,17 @@ class Bitmessage(object):
         print('| Read                    | Read a message from the inbox or outbox    |')
         print('| Save                    | Save message to text file                  |')
         print('| Delete                  | Delete a message or all messages           |')
+        print('| MarkRead                | Mark an inbox message read                 |')
+        print('| MarkUnread              | Mark an inbox message unread               |')
+        print('| ExportAttachments       | Save every attachment in the inbox         |')
+        print('|-------------------------|--------------------------------------------|')
+        print('| DaemonLog               | Show the latest output from the daemon     |')
+        print('| RestartDaemon           | Start the daemon again after it crashed    |')
         print('------------------------------------------------------------------------')
 
 
     def current_settings(self):
-        CONFIG.read(self.keys_file)
+        self.load_config()
         daemon = CONFIG.getboolean('bitmessagesettings', 'daemon')
         timeformat = CONFIG.get('bitmessagesettings', 'timeformat')
         blackwhitelist = CONFIG.get('bitmessagesettings', 'blackwhitelist')
@@ -1751,6 +3443,25 @@ class Bitmessage(object):
             print("Number Of Broadcasts Processed: {0}".format(status['numberOfBroadcastsProcessed']))
         except socket.error:
             print('Couldn\'t check network status due to an API connection issue')
+        self.daemon_status()
+
+
+    def daemon_status(self):
+        supervisor = self.supervisor
+        uptime = supervisor.uptime()
+        if uptime is not None:
+            print("Daemon Uptime: {0}".format(datetime.timedelta(seconds=int(uptime))))
+        elif supervisor.daemon_running():
+            print("Daemon Uptime: Unknown, it wasn't started by the CLI")
+        else:
+            print("Daemon Uptime: Not running")
+        print("Daemon Restarts: {0}".format(supervisor.restarts))
+        if self.time_to_ready is not None:
+            print("Daemon Time To Ready: {0:.2f}s".format(self.time_to_ready))
+        if supervisor.last_exit_code is not None:
+            print("Daemon Last Exit Code: {0}".format(supervisor.last_exit_code))
+        if supervisor.crash_looping:
+            print("Daemon Crash Loop: Yes, it won't be restarted automatically")
 
 
     def run_bitmessage(self):
@@ -1781,41 +3492,584 @@ class Bitmessage(object):
                 else:
                     print('Is the CLI in the same directory as bitmessagemain.py?')
                 self.kill_program()
-            for each in self.enable_bm.stdout:
-                if 'Another instance' in each:
-                    if self.first_run is True:
-#                        print("bitmessagemain.py is already running")
-#                        print("Please close it and re-run the Bitmessage CLI")
-#                        self.kill_program()
-                        pass
-                    break
-                elif each.startswith('Running as a daemon.'):
-                    self.bm_active = True
-                    break
+            self.daemon_output = DaemonOutput(self.enable_bm, log_path=self.daemon_log_file)
+            self.daemon_output.wait_ready(API_READY_TIMEOUT)
+            if self.daemon_output.already_running:
+                if self.first_run is True:
+#                    print("bitmessagemain.py is already running")
+#                    print("Please close it and re-run the Bitmessage CLI")
+#                    self.kill_program()
+                    pass
+
+
+    # Starts the daemon again, even after the supervisor gave up on it
+    def restart_daemon(self):
+        if self.supervisor.daemon_running():
+            print('The daemon is already running.')
+            return
+        if self.supervisor.restart(forced=True) and self.wait_for_api():
+            self.api_import = True
+
+
+    def daemon_log(self):
+        if self.daemon_output is None:
+            print('The daemon hasn\'t been started by the CLI, so there\'s no output to show.')
+            return
+        print('-----------------------------------')
+        for logged, name, line in self.daemon_output.tail():
+            print('{0} [{1}] {2}'.format(time.strftime('%H:%M:%S', time.localtime(logged)), name, line))
+        print('-----------------------------------')
 
 
     def preparations(self):
         self.api_data()
-        try:
-            if self.enable_bm.poll() is None:
-                self.bm_active = True
-            else:
-                self.bm_active = False
-                self.run_bitmessage()
-        except AttributeError:
-            self.bm_active = False
-            self.run_bitmessage()
+        # The API takes a moment to come up after the daemon (re)starts
+        wait_for_api = self.first_run
+        if self.supervisor.daemon_running():
+            self.bm_active = True
+        elif self.supervisor.watcher is None:
+            # Only the first start, after that the watcher restarts it with
+            # backoff, and holds off during a crash loop
+            wait_for_api = self.supervisor.restart() or wait_for_api
 
         if not self.api_import:
-            self.api = xmlrpclib.ServerProxy(self.return_api())
+            self.api_transport.close()
+            self.api_url = self.return_api()
+            self.api = xmlrpclib.ServerProxy(self.api_url,
+                                             transport=self.api_transport)
 
-        if not self.api_check():
+        if wait_for_api:
+            api_ready = self.wait_for_api()
+        else:
+            api_ready = self.api_alive()
+        if not api_ready:
             self.api_import = False
         else:
             if not self.api_import:
                 self.api_import = True
 
 
+    # Subcommands for scripts: bitmessagecli.py <command> [options]
+    def argument_parser(self):
+        parser = argparse.ArgumentParser(description='Command Line Interface for Bitmessage. '
+                                                     'Run without arguments for the interactive prompt.')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help='API calls grouped into one batched request (default: %(default)s)')
+        parser.add_argument('--workers', type=int, default=API_WORKERS,
+                            help='API calls run at once when they can\'t be batched (default: %(default)s)')
+        parser.add_argument('--daemon-log', help='also write the daemon output to this file')
+        parser.add_argument('--attachment-store',
+                            help='keep one copy of each saved attachment here and link to it '
+                                 '(default: {0} next to keys.dat, if it exists)'.format(ATTACHMENT_STORE_DIR))
+        subparsers = parser.add_subparsers(dest='command')
+
+        # These just print, so they run the same as in the interactive prompt
+        for name in ['apitest', 'markallmessagesread', 'markallmessagesunread', 'daemonlog']:
+            subparsers.add_parser(name)
+        for name in ['inbox', 'unread', 'outbox', 'status', 'listaddresses', 'listaddressbook', 'listsubscriptions']:
+            command = subparsers.add_parser(name)
+            command.add_argument('--format', choices=['text', 'json'], default='text')
+        subparsers.choices['inbox'].add_argument('--unread', action='store_true', help='only unread messages')
+
+        command = subparsers.add_parser('read', help='read a message by number or msgid')
+        command.add_argument('message', help='message number or msgid')
+        command.add_argument('--box', choices=['inbox', 'outbox'], default='inbox')
+        command.add_argument('--mark-read', action='store_true')
+        command.add_argument('--format', choices=['text', 'json'], default='text')
+
+        command = subparsers.add_parser('send', help='send a message or broadcast')
+        command.add_argument('--to', help='comma separated for several recipients, not needed with --broadcast')
+        command.add_argument('--from', dest='from_address', required=True)
+        command.add_argument('--subject', default='')
+        body = command.add_mutually_exclusive_group(required=True)
+        body.add_argument('--body')
+        body.add_argument('--body-file', help="file to read the message from, '-' for stdin")
+        command.add_argument('--broadcast', action='store_true')
+
+        command = subparsers.add_parser('delete', help='trash messages')
+        command.add_argument('messages', nargs='+', help="numbers, ranges (1-5), msgids or 'all'")
+        command.add_argument('--box', choices=['inbox', 'outbox'], default='inbox')
+
+        for name in ['subscribe', 'addaddressbook']:
+            command = subparsers.add_parser(name)
+            command.add_argument('--address', required=True)
+            command.add_argument('--label', required=True)
+        for name in ['unsubscribe', 'deleteaddressbook', 'leave', 'addinfo']:
+            command = subparsers.add_parser(name)
+            command.add_argument('--address', required=True)
+        command = subparsers.add_parser('join')
+        command.add_argument('--address', required=True)
+        command.add_argument('--name', required=True)
+        command = subparsers.add_parser('create')
+        command.add_argument('--name', required=True)
+        command = subparsers.add_parser('generateaddress', help='generate a random address')
+        command.add_argument('--label', required=True)
+        command = subparsers.add_parser('exportattachments', help='save every attachment in the inbox')
+        command.add_argument('directory', help='created if it doesn\'t exist')
+        command = subparsers.add_parser('batch', help='run JSON lines like {"op": "send", ...} from a file')
+        command.add_argument('file', nargs='?', default='-', help="defaults to '-' for stdin")
+        return parser
+
+
+    def run_command_line(self, argv):
+        options = self.argument_parser().parse_args(argv)
+        self.interactive = False
+        self.batch_size = options.batch_size
+        self.api_workers = options.workers
+        self.daemon_log_file = options.daemon_log
+        self.attachment_store_path = options.attachment_store
+        try:
+            if not self.connect():
+                self.script_error('Couldn\'t connect to the API')
+                return EXIT_API_UNAVAILABLE
+            handler = getattr(self, 'script_{0}'.format(options.command), None)
+            if handler is not None:
+                exit_code = handler(options)
+            else:
+                command = self.commands[options.command]
+                if isinstance(command, list):
+                    command[0](command[1])
+                else:
+                    command()
+                exit_code = EXIT_OK
+        except PromptRequired as e:
+            self.script_error('This needs an answer to a prompt: {0}'.format(e))
+            return EXIT_USAGE
+        except socket.error:
+            self.api_import = False
+        except (xmlrpclib.Error, xml.parsers.expat.ExpatError, ValueError) as e:
+            self.script_error(str(e))
+            return EXIT_FAILURE
+        except CACHE_ERRORS as e:
+            self.script_error('Message cache error: {0}'.format(e))
+            return EXIT_FAILURE
+        except APIError as e:
+            self.script_error(str(e))
+            return EXIT_FAILURE
+        if not self.api_import:
+            return EXIT_API_UNAVAILABLE
+        return exit_code
+
+
+    # Connects once for a subcommand. A daemon that's already answering is
+    # used as it is, otherwise it gets started like in the interactive prompt.
+    def connect(self):
+        self.api_data()
+        api_url = self.return_api()
+        if api_url is None:
+            return False
+        self.api_url = api_url
+        self.api = xmlrpclib.ServerProxy(api_url, transport=self.api_transport)
+        if self.api_check():
+            return True
+        self.api_import = False
+        self.preparations()
+        return self.api_import
+
+
+    def script_error(self, message):
+        sys.stderr.write('{0}\n'.format(message))
+
+
+    def script_result(self, response):
+        if isinstance(response, basestring) and 'API Error' in response:
+            self.script_error(response)
+            return EXIT_FAILURE
+        print(response)
+        return EXIT_OK
+
+
+    # A message as plain JSON-friendly data, with subject and body decoded
+    def message_summary(self, message, with_body=False):
+        summary = {'msgid': message['msgid'],
+                   'toAddress': message['toAddress'],
+                   'fromAddress': message['fromAddress'],
+                   'subject': base64.b64decode(message['subject'])}
+        for field in ['receivedTime', 'lastActionTime', 'status', 'read']:
+            if field in message:
+                summary[field] = message[field]
+        if with_body:
+            summary['message'] = base64.b64decode(message['message'])
+        return summary
+
+
+    def script_inbox(self, options, unread_only=None):
+        if unread_only is None:
+            unread_only = options.unread
+        if options.format == 'text':
+            self.inbox(unread_only)
+            return EXIT_OK
+        inbox_messages = self.box_messages('inbox')
+        if unread_only:
+            inbox_messages = self.refresh_unread(inbox_messages)
+        messages = [self.message_summary(each) for each in inbox_messages
+                    if not unread_only or not each['read']]
+        print(json.dumps(messages, indent=4))
+        return EXIT_OK
+
+
+    def script_unread(self, options):
+        return self.script_inbox(options, unread_only=True)
+
+
+    def script_outbox(self, options):
+        if options.format == 'text':
+            self.outbox()
+            return EXIT_OK
+        print(json.dumps([self.message_summary(each) for each in self.box_messages('outbox')], indent=4))
+        return EXIT_OK
+
+
+    def script_status(self, options):
+        if options.format == 'text':
+            self.client_status()
+            return EXIT_OK
+        status = json.loads(self.api.clientStatus())
+        status['daemonRestarts'] = self.supervisor.restarts
+        status['daemonUptime'] = self.supervisor.uptime()
+        status['daemonTimeToReady'] = self.time_to_ready
+        print(json.dumps(status, indent=4))
+        return EXIT_OK
+
+
+    def script_listaddresses(self, options):
+        if options.format == 'text':
+            self.list_add()
+        else:
+            print(json.dumps(json.loads(self.api.listAddresses())['addresses'], indent=4))
+        return EXIT_OK
+
+
+    def script_listaddressbook(self, options):
+        if options.format == 'text':
+            self.list_address_book()
+            return EXIT_OK
+        print(json.dumps(self.address_book_entries().entries.values(), indent=4))
+        return EXIT_OK
+
+
+    def script_listsubscriptions(self, options):
+        if options.format == 'text':
+            self.list_subscriptions()
+            return EXIT_OK
+        print(json.dumps(self.subscription_entries().entries.values(), indent=4))
+        return EXIT_OK
+
+
+    def script_read(self, options):
+        message_id = self.message_id_for(options.box, options.message)
+        message = None
+        if message_id is not None:
+            message = self.fetch_message(options.box, message_id)
+        if message is None:
+            self.script_error('No such message: {0}'.format(options.message))
+            return EXIT_FAILURE
+        if options.box == 'inbox' and options.mark_read:
+            self.mark_message_read(message['msgid'])
+        summary = self.message_summary(message, with_body=True)
+        if options.format == 'json':
+            print(json.dumps(summary, indent=4))
+            return EXIT_OK
+        print('To: {0}'.format(summary['toAddress']))
+        print('From: {0}'.format(summary['fromAddress']))
+        print('Subject: {0}'.format(summary['subject']))
+        if options.box == 'inbox':
+            received_time = datetime.datetime.fromtimestamp(float(summary['receivedTime']))
+            print('Received: {0}'.format(received_time.strftime('%Y-%m-%d %H:%M:%S')))
+        else:
+            print('Status: {0}'.format(summary['status']))
+            last_action_time = datetime.datetime.fromtimestamp(float(summary['lastActionTime']))
+            print('Last Action Time: {0}'.format(last_action_time.strftime('%Y-%m-%d %H:%M:%S')))
+        print('Message: {0}'.format(summary['message']))
+        return EXIT_OK
+
+
+    def script_send(self, options):
+        if options.body_file == '-':
+            body = sys.stdin.read()
+        elif options.body_file is not None:
+            with open(options.body_file, 'rb') as body_file:
+                body = body_file.read()
+        else:
+            body = options.body
+        if not options.broadcast and not options.to:
+            self.script_error('--to is needed unless sending a --broadcast')
+            return EXIT_USAGE
+        recipients = []
+        if not options.broadcast:
+            recipients = [each.strip() for each in options.to.split(',') if each.strip()]
+        invalid = self.invalid_addresses([options.from_address] + recipients)
+        if invalid:
+            self.script_error('Invalid address: {0}'.format(', '.join(invalid)))
+            return EXIT_FAILURE
+        subject = base64.b64encode(options.subject)
+        message = base64.b64encode(body)
+        if options.broadcast:
+            return self.script_result(self.api.sendBroadcast(options.from_address, subject, message))
+        if len(recipients) == 1:
+            return self.script_result(self.api.sendMessage(recipients[0], options.from_address, subject, message))
+        results = self.batch_call('sendMessage', [(each, options.from_address, subject, message)
+                                                  for each in recipients])
+        for args, result, error in results:
+            if error is None:
+                print('{0}: {1}'.format(args[0], result))
+            else:
+                self.script_error('{0}: {1}'.format(args[0], error))
+        if any(error is not None for args, result, error in results):
+            return EXIT_FAILURE
+        return EXIT_OK
+
+
+    def script_delete(self, options):
+        message_ids = self.refresh_message_ids(options.box)
+        if [each.lower() for each in options.messages] == ['all']:
+            selected = message_ids
+        else:
+            selected = self.select_messages(' '.join(options.messages), options.box)
+            if not selected:
+                self.script_error('Invalid selection: {0}'.format(' '.join(options.messages)))
+                return EXIT_FAILURE
+        if self.trash_messages(options.box, selected) != len(selected):
+            return EXIT_FAILURE
+        return EXIT_OK
+
+
+    def script_subscribe(self, options):
+        return self.script_result(self.api.addSubscription(options.address, base64.b64encode(options.label)))
+
+
+    def script_unsubscribe(self, options):
+        return self.script_result(self.api.deleteSubscription(options.address))
+
+
+    def script_addaddressbook(self, options):
+        return self.script_result(self.api.addAddressBookEntry(options.address, base64.b64encode(options.label)))
+
+
+    def script_deleteaddressbook(self, options):
+        return self.script_result(self.api.deleteAddressBookEntry(options.address))
+
+
+    def script_join(self, options):
+        return self.script_result(self.api.joinChan(base64.b64encode(options.name), options.address))
+
+
+    def script_leave(self, options):
+        return self.script_result(self.api.leaveChan(options.address))
+
+
+    def script_create(self, options):
+        return self.script_result(self.api.createChan(base64.b64encode(options.name)))
+
+
+    def script_generateaddress(self, options):
+        return self.script_result(self.api.createRandomAddress(base64.b64encode(options.label)))
+
+
+    def script_addinfo(self, options):
+        address_information = decode_address(options.address)
+        print(json.dumps(address_information, indent=4))
+        if address_information.get('status') != 'success':
+            return EXIT_FAILURE
+        return EXIT_OK
+
+
+    def script_exportattachments(self, options):
+        if not os.path.isdir(options.directory):
+            try:
+                os.makedirs(options.directory)
+            except OSError as e:
+                self.script_error('Couldn\'t create {0}: {1}'.format(options.directory, e))
+                return EXIT_FAILURE
+        totals = self.export_inbox_attachments(options.directory)
+        for each in totals['errors']:
+            self.script_error(each)
+        self.script_error(self.export_summary(totals))
+        if totals['errors'] or totals['cancelled']:
+            return EXIT_FAILURE
+        return EXIT_OK
+
+
+    # Runs one JSON record per line through this one connection, printing
+    # a JSON result per record and the overall throughput at the end.
+    # Records are read as they come, so the input can be any size.
+    def script_batch(self, options):
+        operations = {'send': self.batch_send,
+                      'broadcast': self.batch_broadcast,
+                      'subscribe': self.batch_subscribe,
+                      'unsubscribe': self.batch_unsubscribe,
+                      'join': self.batch_join,
+                      'leave': self.batch_leave,
+                      'addaddressbook': self.batch_add_address_book,
+                      'deleteaddressbook': self.batch_delete_address_book,
+                      'delete': self.batch_delete,
+                      'markread': self.batch_mark_read,
+                      'markunread': self.batch_mark_unread}
+        if options.file == '-':
+            records = sys.stdin
+        else:
+            records = open(options.file, 'r')
+        succeeded = 0
+        failed = 0
+        started = time.time()
+        try:
+            for line_number, line in enumerate(iter(records.readline, ''), 1):
+                if not line.strip():
+                    continue
+                result = {'line': line_number}
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    record = None
+                    result['error'] = 'Invalid JSON: {0}'.format(e)
+                if isinstance(record, dict):
+                    result['op'] = record.get('op')
+                    try:
+                        if not isinstance(record.get('op'), basestring) or record['op'] not in operations:
+                            raise ValueError('Unknown op: {0}'.format(record.get('op')))
+                        response = operations[record['op']](record)
+                    except KeyError as e:
+                        result['error'] = 'Missing field: {0}'.format(e.args[0])
+                    except ValueError as e:
+                        result['error'] = str(e)
+                    except xmlrpclib.Fault as e:
+                        result['error'] = e.faultString
+                    except (socket.error, httplib.HTTPException, xmlrpclib.Error) as e:
+                        # The next record tries a fresh connection
+                        result['error'] = 'API connection failed: {0}'.format(e)
+                    else:
+                        if isinstance(response, basestring) and 'API Error' in response:
+                            result['error'] = response
+                        else:
+                            result['result'] = response
+                elif 'error' not in result:
+                    result['error'] = 'Each line has to be a JSON object'
+                if 'error' in result:
+                    failed += 1
+                else:
+                    succeeded += 1
+                print(json.dumps(result))
+                sys.stdout.flush()
+        finally:
+            if records is not sys.stdin:
+                records.close()
+        elapsed = time.time() - started
+        total = succeeded + failed
+        if elapsed > 0:
+            self.script_error('Ran {0} records ({1} failed) in {2:.2f}s ({3:.1f} records/s)'.format(total,
+                                                                                                failed,
+                                                                                                elapsed,
+                                                                                                total / elapsed))
+        if failed:
+            return EXIT_FAILURE
+        return EXIT_OK
+
+
+    # Text from a JSON record, which json.loads gives us as unicode.
+    # Fields without a default are required.
+    def batch_text(self, record, field, default=None):
+        value = record.get(field, default)
+        if value is None:
+            raise KeyError(field)
+        if not isinstance(value, basestring):
+            raise ValueError('{0} has to be a string'.format(field))
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return value
+
+
+    def batch_send(self, record):
+        return self.api.sendMessage(self.batch_text(record, 'to'),
+                                    self.batch_text(record, 'from'),
+                                    base64.b64encode(self.batch_text(record, 'subject', '')),
+                                    base64.b64encode(self.batch_text(record, 'body')))
+
+
+    def batch_broadcast(self, record):
+        return self.api.sendBroadcast(self.batch_text(record, 'from'),
+                                      base64.b64encode(self.batch_text(record, 'subject', '')),
+                                      base64.b64encode(self.batch_text(record, 'body')))
+
+
+    def batch_subscribe(self, record):
+        address = self.batch_text(record, 'address')
+        label = self.batch_text(record, 'label')
+        response = self.api.addSubscription(address, base64.b64encode(label))
+        if 'API Error' not in response:
+            self.subscriptions.add({'address': address, 'label': label, 'enabled': True})
+        return response
+
+
+    def batch_unsubscribe(self, record):
+        address = self.batch_text(record, 'address')
+        response = self.api.deleteSubscription(address)
+        if 'API Error' not in response:
+            self.subscriptions.remove(address)
+        return response
+
+
+    def batch_join(self, record):
+        name = self.batch_text(record, 'name')
+        address = self.batch_text(record, 'address')
+        self.address_index.invalidate()
+        return self.api.joinChan(base64.b64encode(name), address)
+
+
+    def batch_leave(self, record):
+        address = self.batch_text(record, 'address')
+        self.address_index.invalidate()
+        return self.api.leaveChan(address)
+
+
+    def batch_add_address_book(self, record):
+        address = self.batch_text(record, 'address')
+        label = self.batch_text(record, 'label')
+        response = self.api.addAddressBookEntry(address, base64.b64encode(label))
+        if 'API Error' not in response:
+            self.address_book.add({'address': address, 'label': label})
+        return response
+
+
+    def batch_delete_address_book(self, record):
+        address = self.batch_text(record, 'address')
+        response = self.api.deleteAddressBookEntry(address)
+        if 'API Error' not in response:
+            self.address_book.remove(address)
+        return response
+
+
+    def batch_delete(self, record):
+        box = self.batch_text(record, 'box', 'inbox')
+        message_id = self.batch_text(record, 'msgid')
+        if box == 'inbox':
+            response = self.api.trashInboxMessage(message_id)
+        elif box == 'outbox':
+            response = self.api.trashSentMessage(message_id)
+        else:
+            raise ValueError('Invalid box: {0}'.format(box))
+        if 'API Error' not in response:
+            self.forget_messages(box, [message_id])
+        return response
+
+
+    def batch_mark_read(self, record):
+        message_id = self.batch_text(record, 'msgid')
+        response = self.api.getInboxMessageByID(message_id, True)
+        if 'API Error' in response:
+            return response
+        self.set_read(message_id, True)
+        return 'Marked read'
+
+
+    def batch_mark_unread(self, record):
+        message_id = self.batch_text(record, 'msgid')
+        response = self.api.getInboxMessageByID(message_id, False)
+        if 'API Error' in response:
+            return response
+        self.set_read(message_id, False)
+        return 'Marked unread'
+
+
     def main(self):
         while True:
             self.preparations()
@@ -1829,9 +4083,13 @@ class Bitmessage(object):
                 except xml.parsers.expat.ExpatError as e:
                     print(e)
                     self.kill_program()
+                except CACHE_ERRORS as e:
+                    self.drop_message_cache(e)
             else:
                 print('"{0}" is not a command.'.format(command_input))
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(Bitmessage().run_command_line(sys.argv[1:]))
     Bitmessage().main()